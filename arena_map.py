@@ -0,0 +1,279 @@
+import json
+import math
+from typing import Optional
+
+import numpy as np
+
+from raycast import MAX_RANGE, MAX_READING
+
+# Past this many walls, ray casts go through the grid rather than testing every wall
+BRUTE_FORCE_WALLS = 64
+
+
+class ArenaMap:
+    """
+    Walls (segments at any angle) and optional landmark points, compiled into packed
+    arrays for vectorised ray casting.
+
+    Map files are JSON:
+        {
+            "walls": {"OA": [[0, 0], [0, 168]], ...},
+            "landmarks": {"red": [40, 20], ...}
+        }
+
+    Walls are also bucketed into a uniform grid of cell_size cells, so a ray only
+    tests the walls in the cells it passes through.
+    """
+
+    def __init__(
+        self,
+        walls: dict,
+        landmarks: Optional[dict] = None,
+        cell_size: float = 20.0,
+    ):
+        self.walls = {name: [tuple(a), tuple(b)] for name, (a, b) in walls.items()}
+        self.landmarks = {name: tuple(p) for name, p in (landmarks or {}).items()}
+        self.names = list(self.walls)
+
+        self.segments = np.array(
+            [(ax, ay, bx, by) for (ax, ay), (bx, by) in self.walls.values()],
+            dtype=float,
+        ).reshape(-1, 4)
+        delta = self.segments[:, 2:] - self.segments[:, :2]
+        self.lengths = np.hypot(*delta.T)
+        self.directions = delta / self.lengths[:, None]
+        self.normals = np.stack([-self.directions[:, 1], self.directions[:, 0]], axis=1)
+        self.bboxes = np.concatenate(
+            [
+                np.minimum(self.segments[:, :2], self.segments[:, 2:]),
+                np.maximum(self.segments[:, :2], self.segments[:, 2:]),
+            ],
+            axis=1,
+        )
+        # Everything expected() needs per wall, gathered in one go
+        self.packed = np.concatenate(
+            [self.segments, self.normals, self.lengths[:, None] ** 2], axis=1
+        )
+        self.landmark_points = np.array(
+            list(self.landmarks.values()), dtype=float
+        ).reshape(-1, 2)
+
+        self.lo = self.bboxes[:, :2].min(axis=0)
+        self.hi = self.bboxes[:, 2:].max(axis=0)
+        self.build_grid(cell_size)
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "ArenaMap":
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data["walls"], data.get("landmarks"), **kwargs)
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump({"walls": self.walls, "landmarks": self.landmarks}, f, indent=4)
+
+    def build_grid(self, cell_size: float):
+        # Rays are sampled every `step`, so a wall goes in every cell that comes
+        # within step / 2 of it. The sample nearest any hit then finds the wall
+        self.cell_size = cell_size
+        self.step = cell_size
+        # One spare cell all round, for samples just outside the walls' bounding box
+        self.origin = self.lo - cell_size
+        self.shape = tuple(
+            np.floor((self.hi - self.origin) / cell_size).astype(int) + 2
+        )
+        reach = self.step / 2 + cell_size * math.sqrt(2) / 2
+
+        buckets = [[] for _ in range(self.shape[0] * self.shape[1])]
+        for w, (x0, y0, x1, y1) in enumerate(self.bboxes):
+            i0, j0 = np.floor(([x0, y0] - self.origin - reach) / cell_size).astype(int)
+            i1, j1 = np.floor(([x1, y1] - self.origin + reach) / cell_size).astype(int)
+            i, j = np.meshgrid(
+                np.arange(max(i0, 0), min(i1, self.shape[0] - 1) + 1),
+                np.arange(max(j0, 0), min(j1, self.shape[1] - 1) + 1),
+                indexing="ij",
+            )
+            centres = (
+                self.origin
+                + (np.stack([i.ravel(), j.ravel()], axis=1) + 0.5) * cell_size
+            )
+            near = self.point_distances(centres, w) <= reach
+            for cell in (i.ravel() * self.shape[1] + j.ravel())[near]:
+                buckets[cell].append(w)
+
+        depth = max(1, max(len(b) for b in buckets))
+        self.cells = np.full((len(buckets), depth), -1, dtype=np.int32)
+        for cell, walls in enumerate(buckets):
+            self.cells[cell, : len(walls)] = walls
+
+    def point_distances(self, points: np.ndarray, wall: int) -> np.ndarray:
+        a = self.segments[wall, :2]
+        along = np.clip((points - a) @ self.directions[wall], 0, self.lengths[wall])
+        return np.hypot(*(points - a - along[:, None] * self.directions[wall]).T)
+
+    def expected(self, x, y, c, s, walls) -> np.ndarray:
+        """
+        Expected sonar reading for beams (x, y, cos, sin) against the given walls,
+        broadcasting like numpy. inf when the wall is behind or missed, 255 when
+        hit at more than 45 degrees from its normal or out of range.
+        """
+        valid = walls >= 0
+        ax, ay, bx, by, nx, ny, length2 = np.moveaxis(
+            self.packed[np.where(valid, walls, 0)], -1, 0
+        )
+        denom = (by - ay) * c - (bx - ax) * s
+        parallel = denom == 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dist = ((by - ay) * (ax - x) - (bx - ax) * (ay - y)) / np.where(
+                parallel, 1, denom
+            )
+        # How far along the wall the beam crosses it, 0 at a and 1 at b
+        u = (
+            (x + dist * c - ax) * (bx - ax) + (y + dist * s - ay) * (by - ay)
+        ) / length2
+        unseen = ~valid | parallel | (dist < 0) | (u < 0) | (u > 1)
+
+        incidence = np.abs(c * nx + s * ny)
+        shallow = incidence < math.cos(math.pi / 4)
+        dist = np.where(shallow | (dist > MAX_RANGE), MAX_READING, dist)
+        return np.where(unseen, np.inf, dist)
+
+    def cast(self, x, y, theta) -> np.ndarray:
+        """
+        Expected sonar reading for each pose, i.e. the closest wall along the beam
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        c, s = np.cos(theta), np.sin(theta)
+        if len(self.segments) <= BRUTE_FORCE_WALLS:
+            walls = np.arange(len(self.segments))
+            return self.expected(
+                x[:, None], y[:, None], c[:, None], s[:, None], walls
+            ).min(axis=1)
+        return self.cast_grid(x, y, c, s)
+
+    def cast_grid(self, x, y, c, s, chunk: int = 4) -> np.ndarray:
+        # March every ray through the grid `chunk` samples at a time, dropping rays
+        # once nothing further along could beat what they already hit
+        best = np.full(len(x), np.inf)
+        active = np.arange(len(x))
+        # No wall is further away than the furthest corner of the map
+        length = max(
+            np.hypot(x - cx, y - cy).max(initial=0)
+            for cx in (self.lo[0], self.hi[0])
+            for cy in (self.lo[1], self.hi[1])
+        )
+        t = 0.0
+        while len(active) and t <= length + self.step:
+            ts = t + self.step * np.arange(chunk)
+            xa, ya, ca, sa = x[active], y[active], c[active], s[active]
+            px = xa[:, None] + ts * ca[:, None]
+            py = ya[:, None] + ts * sa[:, None]
+            i = np.floor((px - self.origin[0]) / self.cell_size).astype(int)
+            j = np.floor((py - self.origin[1]) / self.cell_size).astype(int)
+            inside = (i >= 0) & (i < self.shape[0]) & (j >= 0) & (j < self.shape[1])
+            cell = np.where(inside, i * self.shape[1] + j, 0)
+            walls = np.where(inside[..., None], self.cells[cell], -1)
+            walls = walls.reshape(len(active), -1)
+
+            found = self.expected(
+                xa[:, None], ya[:, None], ca[:, None], sa[:, None], walls
+            ).min(axis=1)
+            best[active] = np.minimum(best[active], found)
+
+            # Every wall hit up to here has been tested by now
+            t = ts[-1] + self.step
+            reached = ts[-1] - self.step / 2
+            done = best[active] <= reached
+            done |= (best[active] == MAX_READING) & (reached >= MAX_RANGE)
+            active = active[~done]
+        return best
+
+    def crossings(self, x0, y0, x1, y1) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Where each move from (x0, y0) to (x1, y1) first crosses a wall: the fraction
+        of the move (inf if it never does) and which wall (-1 if none)
+        """
+        x0, y0 = np.asarray(x0, dtype=float), np.asarray(y0, dtype=float)
+        dx, dy = np.asarray(x1) - x0, np.asarray(y1) - y0
+        if len(self.segments) <= BRUTE_FORCE_WALLS:
+            walls = np.broadcast_to(
+                np.arange(len(self.segments)), (len(x0), len(self.segments))
+            )
+        else:
+            # Moves are short, so the walls in the cells along them will do
+            samples = int(np.hypot(dx, dy).max(initial=0) // self.step) + 2
+            ts = np.linspace(0, 1, samples)
+            i = np.floor(
+                (x0[:, None] + ts * dx[:, None] - self.origin[0]) / self.cell_size
+            ).astype(int)
+            j = np.floor(
+                (y0[:, None] + ts * dy[:, None] - self.origin[1]) / self.cell_size
+            ).astype(int)
+            inside = (i >= 0) & (i < self.shape[0]) & (j >= 0) & (j < self.shape[1])
+            cell = np.where(inside, i * self.shape[1] + j, 0)
+            walls = np.where(inside[..., None], self.cells[cell], -1).reshape(
+                len(x0), -1
+            )
+
+        valid = walls >= 0
+        ax, ay, bx, by = np.moveaxis(self.packed[np.where(valid, walls, 0), :4], -1, 0)
+        ex, ey = bx - ax, by - ay
+        denom = dx[:, None] * ey - dy[:, None] * ex
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = ((ax - x0[:, None]) * ey - (ay - y0[:, None]) * ex) / denom
+            u = (
+                (ax - x0[:, None]) * dy[:, None] - (ay - y0[:, None]) * dx[:, None]
+            ) / denom
+        hit = valid & (denom != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+        t = np.where(hit, t, np.inf)
+        first = np.argmin(t, axis=1)
+        rows = np.arange(len(x0))
+        return t[rows, first], np.where(
+            np.isfinite(t[rows, first]), walls[rows, first], -1
+        )
+
+    def reflect(self, x, y, walls) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Mirror each point in the line of its wall
+        """
+        a = self.segments[walls, :2]
+        normal = self.normals[walls]
+        points = np.stack([x, y], axis=1)
+        offset = np.sum((points - a) * normal, axis=1)
+        points -= 2 * offset[:, None] * normal
+        return points[:, 0], points[:, 1]
+
+    def random_poses(self, n: int, rng: np.random.Generator):
+        # Uniform over the bounding box of the walls, any heading
+        x, y = rng.uniform(self.lo, self.hi, (n, 2)).T
+        return x, y, rng.uniform(-math.pi, math.pi, n)
+
+    def free(self, x, y, clearance: float = 0.0) -> np.ndarray:
+        """
+        Whether each point is inside the arena (some wall in every direction) and at
+        least clearance from the nearest wall
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        inside = np.ones(len(x), dtype=bool)
+        for theta in np.arange(8) * math.pi / 4 + 0.01:  # Off axis, never parallel
+            inside &= np.isfinite(self.cast(x, y, np.full(len(x), theta)))
+        if clearance > 0:
+            points = np.stack([x, y], axis=1)
+            for wall in range(len(self.segments)):
+                inside &= self.point_distances(points, wall) >= clearance
+        return inside
+
+    def random_free_poses(
+        self, n: int, rng: np.random.Generator, clearance: float = 0.0
+    ):
+        # Uniform over the free space, by rejection from the bounding box
+        xs, ys = [np.empty(0)], [np.empty(0)]
+        while sum(map(len, xs)) < n:
+            x, y, _ = self.random_poses(2 * n, rng)
+            keep = self.free(x, y, clearance)
+            xs.append(x[keep])
+            ys.append(y[keep])
+        x, y = np.concatenate(xs)[:n], np.concatenate(ys)[:n]
+        return x, y, rng.uniform(-math.pi, math.pi, n)
@@ -0,0 +1,443 @@
+# Benchmarks for the localisation pipeline, run with: python bench.py
+# Runs off the robot too (probalistic_motion mocks the motors when not on the pi)
+import contextlib
+import io
+import math
+import os
+import time
+
+import numpy as np
+
+import mcl
+from arena_map import ArenaMap
+from likelihood_field import LikelihoodField
+from probalistic_motion import ParticleCloud, Position
+import raycast
+import sonar
+from sharded_mcl import ShardedRobot
+
+
+# Poses in the bottom strip of the arena, where every bearing hits a wall
+def random_poses(n: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return (
+        rng.uniform(1, 209, n),
+        rng.uniform(1, 83, n),
+        rng.uniform(-math.pi, math.pi, n),
+    )
+
+
+def rate(f, n: int, min_time: float = 0.5) -> float:
+    """
+    Particles per second for f(), repeating until min_time has passed
+    """
+    runs = 0
+    t = time.perf_counter()
+    while True:
+        f()
+        runs += 1
+        elapsed = time.perf_counter() - t
+        if elapsed > min_time:
+            return runs * n / elapsed
+
+
+def bench_likelihood():
+    # NormRobot.log_likelihood is what every sonar update goes through
+    z = 60
+    robots = [
+        ("ray cast", mcl.NormRobot(1, 84, 30, 0)),
+        ("table", mcl.NormRobot(1, 84, 30, 0, use_table=True)),
+    ]
+    for n in [100, 1000, 10000, 50000]:
+        x, y, theta = random_poses(n)
+        rates = [
+            f"{name} {rate(lambda: robot.log_likelihood(x, y, theta, z), n):12,.0f} p/s"
+            for name, robot in robots
+        ]
+        print(f"likelihood n={n:6d}: " + ", ".join(rates))
+
+
+def bench_table():
+    t = time.perf_counter()
+    table = raycast.RaycastTable.load(mcl.ARENA)
+    print(f"table load {time.perf_counter() - t:.3f}s, shape {table.table.shape}")
+
+    n = 50000
+    x, y, theta = random_poses(n)
+    exact = mcl.ARENA.cast(x, y, theta)
+    for interpolate in [False, True]:
+        looked_up = table.lookup(x, y, theta, interpolate)
+        both = (exact < raycast.MAX_READING) & (looked_up < raycast.MAX_READING)
+        err = np.abs(exact - looked_up)[both]
+        fast = rate(lambda: table.lookup(x, y, theta, interpolate), n)
+        print(
+            f"table interpolate={interpolate}: {fast:12,.0f} p/s, "
+            f"median error {np.median(err):.2f}cm, agree on 255/inf "
+            f"{np.mean((exact >= 255) == (looked_up >= 255)):.1%}"
+        )
+
+
+def bench_sonar_measure():
+    # Simulated NXT sonar: steady readings (sensor_findings.md) with ~10% garbage
+    rng = np.random.default_rng(0)
+
+    def read():
+        return 42 if rng.random() > 0.1 else float(rng.integers(0, 256))
+
+    samples = [sonar.measure(read, period=0)[1] for _ in range(1000)]
+    print(
+        f"adaptive sonar: {np.mean(samples):.1f} samples on average "
+        f"(max {max(samples)}), {(20 - np.mean(samples)) * 10:.0f}ms saved per "
+        f"reading against 20 samples at 10ms"
+    )
+
+
+def bench_sharded(n: int = 200000):
+    # One motion and one sensor update per step, against the single process robot
+    robots = [("single", mcl.NormRobot(n, 84, 30, 0))]
+    for workers in range(1, (os.cpu_count() or 1) + 1):
+        robots.append(
+            (f"{workers} workers", ShardedRobot(n, 84, 30, 0, workers=workers))
+        )
+
+    for name, robot in robots:
+        robot.resample_threshold = 0  # Time the updates, not the resampling
+
+        def step():
+            robot.predict_forward(10)
+            with contextlib.redirect_stdout(io.StringIO()):
+                robot.normalise_probs(60)
+
+        print(f"sharded {name:>10}: {rate(step, n):12,.0f} p/s per step")
+        if isinstance(robot, ShardedRobot):
+            robot.close()
+
+
+def random_arena(walls: int, rng: np.random.Generator) -> ArenaMap:
+    # Square room with the same wall density as mcl.WALLS, filled with random walls
+    side = math.sqrt(walls * 210**2 / 9)
+    corners = [(0, 0), (side, 0), (side, side), (0, side), (0, 0)]
+    segments = {
+        f"edge{i}": [a, b] for i, (a, b) in enumerate(zip(corners, corners[1:]))
+    }
+    for i in range(walls - 4):
+        x, y = rng.uniform(0, side, 2)
+        length = rng.uniform(20, 80)
+        end = (
+            (min(side, x + length), y)
+            if rng.random() < 0.5
+            else (x, min(side, y + length))
+        )
+        segments[f"wall{i}"] = [(x, y), end]
+    return ArenaMap(segments)
+
+
+def bench_map(n: int = 20000):
+    rng = np.random.default_rng(0)
+    for walls in [9, 50, 100, 200, 400, 800]:
+        arena = random_arena(walls, rng)
+        x, y = rng.uniform(arena.lo, arena.hi, (n, 2)).T
+        theta = rng.uniform(-math.pi, math.pi, n)
+        c, s = np.cos(theta), np.sin(theta)
+        every_wall = np.arange(len(arena.segments))
+
+        def brute():
+            arena.expected(x[:, None], y[:, None], c[:, None], s[:, None], every_wall)
+
+        grid = rate(lambda: arena.cast_grid(x, y, c, s), n)
+        print(
+            f"map {walls:3d} walls: grid {grid:12,.0f} p/s, "
+            f"every wall {rate(brute, n):12,.0f} p/s"
+        )
+
+
+def simulate(
+    robot: mcl.NormRobot, laps: int = 2, seed: int = 0, camera: bool = False
+) -> float:
+    """
+    Drive the filter (not the motors) round a loop in the bottom of the arena with
+    noisy motion and sonar (10% garbage), returning the mean position error.
+    With camera, the robot's arena landmarks within 60 degrees of straight ahead are
+    seen too, with 3 degrees of bearing noise and 5% of range noise
+    """
+    rng = np.random.default_rng(seed)
+    true = Position(84, 30, 0)
+    errors = []
+    legs = [4, 2, 4, 2]
+    for _ in range(laps):
+        for steps in legs:
+            for _ in range(steps):
+                robot.predict_forward(20)
+                true.move_forward(20 + rng.normal(0, 1))
+                true.rotate(rng.normal(0, 0.02))
+                z = mcl.ARENA.cast([true.x], [true.y], [true.theta])[0]
+                # With the sensor's systematic error, which the model corrects for
+                z = robot.sonar_model.scale * z + robot.sonar_model.bias
+                if rng.random() < 0.1:
+                    z = rng.uniform(0, 255)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    if camera:
+                        robot.observe_landmarks(sightings(robot.arena, true, rng))
+                    robot.normalise_probs(min(255.0, z + rng.normal(0, 1)))
+                x, y, _ = robot.getMeanPos()
+                errors.append(math.hypot(x - true.x, y - true.y))
+            robot.predict_rotate(-math.pi / 2)
+            true.rotate(-math.pi / 2 + rng.normal(0, 0.02))
+    return float(np.mean(errors))
+
+
+def sightings(arena: ArenaMap, true: Position, rng: np.random.Generator):
+    # Worked out from Position's own conventions rather than relative_positions, so
+    # a sign slip there shows up as the camera making things worse: the heading to
+    # each landmark as move_forward would drive it, less the robot's, is its bearing
+    # with left positive, as a positive rotate turns left
+    seen = []
+    for lx, ly in arena.landmark_points:
+        heading = math.atan2(-(ly - true.y), lx - true.x)
+        bearing = Position.normalise(heading - true.theta)
+        bearing += rng.normal(0, math.radians(3))
+        distance = math.hypot(lx - true.x, ly - true.y) * (1 + rng.normal(0, 0.05))
+        if abs(bearing) < math.radians(60) and distance < 100:
+            seen.append((distance * math.cos(bearing), distance * math.sin(bearing)))
+    return seen
+
+
+def bench_landmarks(seeds: int = 5):
+    # Three red markers in the bottom strip, where simulate drives
+    arena = ArenaMap(mcl.WALLS, {"a": (40, 10), "b": (200, 40), "c": (130, 80)})
+    for camera in [False, True]:
+        errors = [
+            simulate(
+                mcl.NormRobot(500, 84, 30, 0, arena=arena), seed=seed, camera=camera
+            )
+            for seed in range(seeds)
+        ]
+        name = "sonar and camera" if camera else "sonar only"
+        print(f"landmarks: {name:16}, mean error {np.mean(errors):.1f}cm")
+
+
+def kidnapped(robot: mcl.NormRobot, seed: int = 0) -> float:
+    """
+    Spin on the spot at the start pose taking readings, then carry the robot off
+    to the other side of the arena and keep spinning. Returns the final position
+    error, which stays large unless the filter notices and recovers
+    """
+    rng = np.random.default_rng(seed)
+    true = Position(84, 30, 0)
+    model = robot.sonar_model
+    for spin in range(50):
+        if spin == 10:
+            true = Position(150, 40, math.pi / 2)
+        for _ in range(4):
+            z = model.scale * mcl.ARENA.cast([true.x], [true.y], [true.theta])[0]
+            z += model.bias
+            if rng.random() < 0.1:
+                z = rng.uniform(0, 255)
+            with contextlib.redirect_stdout(io.StringIO()):
+                robot.normalise_probs(min(255.0, z + rng.normal(0, 1)))
+                robot.predict_rotate(math.pi / 2)
+            true.rotate(math.pi / 2)
+    x, y, _ = robot.getMeanPos()
+    return math.hypot(x - true.x, y - true.y)
+
+
+def bench_kld(seeds: int = 10):
+    """
+    Tracking error on the simulate loop, and how often the filter finds the robot
+    again after kidnapping it, for KLD sampling's recovery settings
+    """
+    configs = [
+        ("no KLD", None),
+        ("KLD, scatter on 1 bad", dict(alpha_slow=0.05, patience=1)),
+        ("KLD, defaults", {}),
+        ("KLD, no recovery", dict(alpha_fast=0.01)),
+    ]
+    for name, kld in configs:
+
+        def robot():
+            kwargs = {} if kld is None else dict(kld=mcl.KLDSampling(**kld))
+            return mcl.NormRobot(500, 84, 30, 0, **kwargs)
+
+        errors, found = [], 0
+        for seed in range(seeds):
+            with contextlib.redirect_stdout(io.StringIO()):
+                errors.append(simulate(robot(), seed=seed))
+                found += kidnapped(robot(), seed) < 10
+        print(
+            f"kld {name:22}: mean error {np.mean(errors):4.1f}cm, "
+            f"found again after kidnapping {found}/{seeds}"
+        )
+
+
+def bench_field(n: int = 10000):
+    model = mcl.SonarModel(sigma=2.0)
+    field = LikelihoodField.load(mcl.ARENA)
+    x, y, theta = random_poses(n)
+    ray = rate(lambda: model.log_likelihood(mcl.ARENA.cast(x, y, theta), 60), n)
+    fast = rate(lambda: field.log_likelihood(x, y, theta, 60, model), n)
+    print(f"sensor model speed: ray cast {ray:12,.0f} p/s, field {fast:12,.0f} p/s")
+
+    for use_field in [False, True]:
+        errors = [
+            simulate(
+                mcl.NormRobot(500, 84, 30, 0, sonar_model=model, use_field=use_field),
+                seed=seed,
+            )
+            for seed in range(5)
+        ]
+        name = "field" if use_field else "ray cast"
+        print(f"sensor model accuracy: {name:8}, mean error {np.mean(errors):.1f}cm")
+
+
+def bench_scan(n: int = 2000, steps: int = 16, seeds: int = 10):
+    """
+    A full turn of readings from a cloud 10cm / 15 degrees wide: one normalise_probs
+    per bearing (turning in between) against a single scan_update of all of them.
+    On the robot the second also saves stopping for every reading
+    """
+    true = (84.0, 30.0, 0.0)
+    bearings = np.arange(steps) * 2 * math.pi / steps
+    for batched in [False, True]:
+        errors, elapsed = [], 0.0
+        for seed in range(seeds):
+            rng = np.random.default_rng(seed)
+            robot = mcl.NormRobot(n, *true)
+            robot.rng = rng
+            robot.particle_cloud = ParticleCloud(
+                rng.normal(true[0], 10, n),
+                rng.normal(true[1], 10, n),
+                rng.normal(true[2], math.radians(15), n),
+                np.full(n, 1.0 / n),
+            )
+            z = mcl.ARENA.cast(
+                np.full(steps, true[0]), np.full(steps, true[1]), true[2] + bearings
+            )
+            z = robot.sonar_model.scale * z + robot.sonar_model.bias
+            z = np.minimum(255.0, z + rng.normal(0, 1, steps))
+            t = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                if batched:
+                    robot.predict_rotate(2 * math.pi)
+                    robot.scan_update(list(zip(bearings, z)))
+                else:
+                    for k in range(steps):
+                        robot.predict_rotate(bearings[k] - bearings[k - 1] if k else 0)
+                        robot.normalise_probs(z[k])
+                    robot.predict_rotate(2 * math.pi - bearings[-1])
+            elapsed += time.perf_counter() - t
+            x, y, _ = robot.getMeanPos()
+            errors.append(math.hypot(x - true[0], y - true[1]))
+        name = "one scan update" if batched else "update per bearing"
+        print(
+            f"scan of {steps}: {name:18}, {elapsed / seeds * 1000:6.1f}ms, "
+            f"median error {np.median(errors):.1f}cm"
+        )
+
+
+def drive(driver, move) -> dict:
+    """
+    Run move(driver) on a driver over a SimBrickPi3 and let the wheels coast to a
+    stop. Reports the CPU time, SPI transactions, largest gap between the wheels'
+    progress (by driver.read's counting) and where they stopped
+    """
+    mismatch = []
+    flips = (-1 if driver.flipL else 1, -1 if driver.flipR else 1)
+    driver.listeners.append(
+        lambda l, r: mismatch.append(abs(l * flips[0] - r * flips[1]))
+    )
+    transactions = driver.BP.transactions
+    cpu = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        move(driver)
+    cpu = time.process_time() - cpu
+    transactions = driver.BP.transactions - transactions
+    time.sleep(0.5)
+    driver.listeners.clear()
+    return dict(
+        cpu=cpu,
+        transactions=transactions,
+        mismatch=max(mismatch),
+        stopped=driver.read(),
+    )
+
+
+def bench_drive():
+    """
+    2 rotation moves (and half rotation turns) on simulated wheels, the right one
+    10% weaker
+    """
+    from motor_driver import MotorDriver
+    from sim_brickpi import SimBrickPi3
+
+    for backend in ["pid", "firmware"]:
+        bp = SimBrickPi3()
+        driver = MotorDriver(bp.PORT_C, bp.PORT_B, scale=5, backend=backend, bp=bp)
+        driver.flipR = True
+        result = drive(driver, lambda d: d.move_forward(2))
+        print(
+            f"drive {backend:8}: {result['cpu'] * 1000:4.0f}ms CPU, "
+            f"{result['transactions']:4d} SPI transactions, peak mismatch "
+            f"{result['mismatch']:3d} degrees, stopped at {result['stopped']} of 720"
+        )
+
+    # The PID backend's motion profiles: overshoot on a move and a turn on the spot
+    for profile in ["trapezoid", "s_curve"]:
+        bp = SimBrickPi3()
+        driver = MotorDriver(bp.PORT_C, bp.PORT_B, scale=5, bp=bp)
+        driver.flipR = True
+        driver.controller.profile = profile
+        forward = drive(driver, lambda d: d.move_forward(2))["stopped"]
+        turn = drive(driver, lambda d: d.rotate(0.5))["stopped"]
+        print(
+            f"profile {profile:9}: move overshoot {max(forward) - 720:3d} degrees, "
+            f"turn overshoot {max(map(abs, turn)) - 180:3d} degrees"
+        )
+
+
+def bench_cache():
+    """
+    SPI transactions for 3 moves and turns through CachedBrickPi3, against the same
+    layer with its write cache and software encoder zeroing turned off
+    """
+    from cached_brickpi import CachedBrickPi3
+    from motor_driver import MotorDriver
+    from sim_brickpi import SimBrickPi3
+
+    class Uncached(CachedBrickPi3):
+        def _write(self, setting, port, value, send):
+            send()
+
+        def offset_motor_encoder(self, port, position):
+            self.bp.offset_motor_encoder(port, position)
+
+    for backend in ["pid", "firmware"]:
+        counts = []
+        for layer in [Uncached, CachedBrickPi3]:
+            bp = SimBrickPi3()
+            driver = MotorDriver(bp.PORT_C, bp.PORT_B, scale=5, backend=backend, bp=bp)
+            driver.BP = layer(bp)
+            driver.flipR = True
+            transactions = bp.transactions
+            with contextlib.redirect_stdout(io.StringIO()):
+                for _ in range(3):
+                    driver.move_forward(1)
+                    driver.rotate(0.5)
+            counts.append(bp.transactions - transactions)
+        print(
+            f"cache {backend:8}: {counts[0]} SPI transactions uncached, "
+            f"{counts[1]} cached"
+        )
+
+
+if __name__ == "__main__":
+    bench_likelihood()
+    bench_table()
+    bench_sonar_measure()
+    bench_sharded()
+    bench_map()
+    bench_field()
+    bench_kld()
+    bench_landmarks()
+    bench_scan()
+    bench_drive()
+    bench_cache()
@@ -14,6 +14,7 @@ from __future__ import division
 
 import subprocess  # for executing system calls
 import spidev
+import threading
 import array  # for converting hex string to byte array
 
 FIRMWARE_VERSION_REQUIRED = "1.4.x"  # Make sure the top 2 of 3 numbers match
@@ -24,6 +25,10 @@ BP_SPI.max_speed_hz = 500000
 BP_SPI.mode = 0b00
 BP_SPI.bits_per_word = 8
 
+# BP_SPI is shared by every thread (sonar.SonarService polls it from its own), so
+# transactions take this lock to keep one from starting in the middle of another
+SPI_LOCK = threading.Lock()
+
 
 class Enumeration(object):
     def __init__(self, names):  # or *names, with no .split()
@@ -91,7 +96,8 @@ def set_address(address, id):
 
     outArray = [0, BrickPi3.BPSPI_MESSAGE_TYPE.SET_ADDRESS, address]
     outArray.extend(id_arr)
-    BP_SPI.xfer2(outArray)
+    with SPI_LOCK:
+        BP_SPI.xfer2(outArray)
 
 
 class BrickPi3(object):
@@ -342,7 +348,8 @@ class BrickPi3(object):
 
         Returns a list of the bytes read.
         """
-        return BP_SPI.xfer2(data_out)
+        with SPI_LOCK:
+            return BP_SPI.xfer2(data_out)
 
     def spi_write_8(self, MessageType, Value):
         """
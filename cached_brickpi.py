@@ -0,0 +1,181 @@
+import time
+
+import brickpi3
+
+MOTOR_PORTS = (
+    brickpi3.BrickPi3.PORT_A,
+    brickpi3.BrickPi3.PORT_B,
+    brickpi3.BrickPi3.PORT_C,
+    brickpi3.BrickPi3.PORT_D,
+)
+
+
+class CachedBrickPi3:
+    """
+    A BrickPi3 that does fewer SPI transactions for the same calls:
+
+    - Motor settings (power, position, dps, limits, kp, kd) are remembered per port
+      as they are written, and writing what a port already has is skipped.
+    - Encoders are zeroed in software, offset_motor_encoder moves a baseline here
+      rather than the firmware's, and encoder readings and position targets are
+      translated by it.
+    - read_many reads several encoders back to back, with the messages built once.
+
+    Anything else goes straight to the BrickPi3 underneath. Transactions made and
+    saved are counted, summary() reports them.
+    """
+
+    def __init__(self, bp=None):
+        self.bp = brickpi3.BrickPi3() if bp is None else bp
+        self.transactions = 0
+        self.saved = 0
+        self.window = (time.monotonic(), 0, 0)  # Where summary() last left off
+        transfer = self.bp.spi_transfer_array
+
+        def counted(data_out):
+            self.transactions += 1
+            return transfer(data_out)
+
+        # The BrickPi3 methods all go through this, so it counts every transaction
+        self.bp.spi_transfer_array = counted
+        self.sent = {}  # (setting, port) -> what it was last set to
+        self.baseline = dict.fromkeys(MOTOR_PORTS, 0)
+        types = self.bp.BPSPI_MESSAGE_TYPE
+        self.encoder_messages = {
+            port: [self.bp.SPI_Address, message, 0, 0, 0, 0, 0, 0]
+            for port, message in zip(
+                MOTOR_PORTS,
+                (
+                    types.GET_MOTOR_A_ENCODER,
+                    types.GET_MOTOR_B_ENCODER,
+                    types.GET_MOTOR_C_ENCODER,
+                    types.GET_MOTOR_D_ENCODER,
+                ),
+            )
+        }
+
+    def __getattr__(self, name):
+        if name == "bp":  # Not set up yet, don't recurse
+            raise AttributeError(name)
+        return getattr(self.bp, name)
+
+    def _write(self, setting, port, value, send):
+        ports = [p for p in MOTOR_PORTS if port & p]
+        if all(self.sent.get((setting, p)) == value for p in ports):
+            self.saved += 1
+            return
+        send()
+        for p in ports:
+            self.sent[setting, p] = value
+
+    def invalidate(self):
+        """
+        Forget what the motors were set to, for when something else may have changed it
+        """
+        self.sent.clear()
+
+    # Power, position and dps are one setting, each switches the motor's mode
+    def set_motor_power(self, port, power):
+        self._write(
+            "control",
+            port,
+            ("power", int(power)),
+            lambda: self.bp.set_motor_power(port, power),
+        )
+
+    def set_motor_dps(self, port, dps):
+        self._write(
+            "control", port, ("dps", int(dps)), lambda: self.bp.set_motor_dps(port, dps)
+        )
+
+    def set_motor_position(self, port, position):
+        # Targets are in the firmware's encoder degrees, so ports with different
+        # baselines need separate messages
+        for base in {self.baseline[p] for p in MOTOR_PORTS if port & p}:
+            group = sum(p for p in MOTOR_PORTS if port & p and self.baseline[p] == base)
+            target = int(position) + base
+            self._write(
+                "control",
+                group,
+                ("position", target),
+                lambda: self.bp.set_motor_position(group, target),
+            )
+
+    def set_motor_position_relative(self, port, degrees):
+        for p in MOTOR_PORTS:
+            if port & p:
+                self.set_motor_position(p, self.get_motor_encoder(p) + degrees)
+
+    def set_motor_limits(self, port, power=0, dps=0):
+        self._write(
+            "limits",
+            port,
+            (int(power), int(dps)),
+            lambda: self.bp.set_motor_limits(port, power, dps),
+        )
+
+    def set_motor_position_kp(self, port, kp=25):
+        self._write(
+            "kp", port, int(kp), lambda: self.bp.set_motor_position_kp(port, kp)
+        )
+
+    def set_motor_position_kd(self, port, kd=70):
+        self._write(
+            "kd", port, int(kd), lambda: self.bp.set_motor_position_kd(port, kd)
+        )
+
+    def get_motor_encoder(self, port):
+        return self.bp.get_motor_encoder(port) - self.baseline[port]
+
+    def get_motor_status(self, port):
+        status = self.bp.get_motor_status(port)
+        status[2] -= self.baseline[port]
+        return status
+
+    def offset_motor_encoder(self, port, position):
+        for p in MOTOR_PORTS:
+            if port & p:
+                self.baseline[p] += int(position)
+                self.saved += 1
+
+    def reset_motor_encoder(self, port):
+        ports = [p for p in MOTOR_PORTS if port & p]
+        for p, position in zip(ports, self.read_many(ports)):
+            self.offset_motor_encoder(p, position)
+
+    def read_many(self, ports) -> list[int]:
+        """
+        Encoder readings (degrees, as get_motor_encoder) of each of ports, one motor
+        port each. The transfers are all made before any reply is decoded
+        """
+        transfer = self.bp.spi_transfer_array
+        messages = self.encoder_messages
+        # xfer2 may hand the buffer back as the reply, so send copies
+        replies = [transfer(messages[port][:]) for port in ports]
+        encoders = []
+        for port, reply in zip(ports, replies):
+            if reply[3] != 0xA5:
+                raise IOError("No SPI response")
+            encoder = (reply[4] << 24) | (reply[5] << 16) | (reply[6] << 8) | reply[7]
+            if encoder & 0x80000000:
+                encoder -= 0x100000000
+            encoders.append(encoder - self.baseline[port])
+        return encoders
+
+    def reset_all(self):
+        self.bp.reset_all()
+        self.invalidate()
+
+    def summary(self) -> str:
+        """
+        Transactions made and saved since the last summary
+        """
+        start, transactions, saved = self.window
+        now = time.monotonic()
+        self.window = (now, self.transactions, self.saved)
+        elapsed = max(now - start, 1e-9)
+        made, saved = self.transactions - transactions, self.saved - saved
+        return (
+            f"{made} SPI transactions ({made / elapsed:.0f}/s), "
+            f"{saved} saved ({saved / elapsed:.0f}/s)"
+        )
@@ -3,6 +3,38 @@ from probalistic_motion import Robot, motion
 from calibrate_camera import HInv, HtransformUVtoXY, cv2, np, Picamera2
 
 
+def red_blobs(img, min_area: float = 150):
+    """
+    Ground plane (forward, left) position in cm of each red blob in a camera image
+    """
+    # Convert to HSV colour space
+    img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+
+    # Apply colour thresholding: for red this is done in two steps
+    # lower mask (0-10)
+    lower_red = np.array([0, 50, 50])
+    upper_red = np.array([10, 255, 255])
+    mask0 = cv2.inRange(hsv, lower_red, upper_red)
+    # upper mask (170-180)
+    lower_red = np.array([170, 50, 50])
+    upper_red = np.array([180, 255, 255])
+    mask1 = cv2.inRange(hsv, lower_red, upper_red)
+    # join my masks
+    mask = mask0 + mask1
+    # Calculate connected components: colour thresholded "blob" regions
+    output = cv2.connectedComponentsWithStats(mask, 4, cv2.CV_32F)
+    (numLabels, labels, stats, centroids) = output
+
+    # Find the properties of the detected blobs
+    for i in range(1, numLabels):
+        area = stats[i, cv2.CC_STAT_AREA]
+        (cu, cv) = centroids[i]
+        # Keep the blobs above a certain size
+        if area > min_area:
+            yield HtransformUVtoXY(HInv, cu, cv)
+
+
 class Columbussy(Robot):
     def __init__(
         self, x: float, y: float, theta: float, left_lim: float, right_lim: float, fwd_lim: float
@@ -18,34 +50,7 @@ class Columbussy(Robot):
         atexit.register(self.picam2.stop)
 
     def get_obstacles(self):
-        img = self.picam2.capture_array()
-
-        # Convert to HSV colour space
-        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-
-        # Apply colour thresholding: for red this is done in two steps
-        # lower mask (0-10)
-        lower_red = np.array([0, 50, 50])
-        upper_red = np.array([10, 255, 255])
-        mask0 = cv2.inRange(hsv, lower_red, upper_red)
-        # upper mask (170-180)
-        lower_red = np.array([170, 50, 50])
-        upper_red = np.array([180, 255, 255])
-        mask1 = cv2.inRange(hsv, lower_red, upper_red)
-        # join my masks
-        mask = mask0 + mask1
-        # Calculate connected components: colour thresholded "blob" regions
-        output = cv2.connectedComponentsWithStats(mask, 4, cv2.CV_32F)
-        (numLabels, labels, stats, centroids) = output
-
-        # Find the properties of the detected blobs
-        for i in range(1, numLabels):
-            area = stats[i, cv2.CC_STAT_AREA]
-            (cu, cv) = centroids[i]
-            # Print out the properties of blobs above a certain size
-            if area > 150:
-                yield HtransformUVtoXY(HInv, cu, cv)
+        yield from red_blobs(self.picam2.capture_array())
 
     def get_dangerous_obstacles(self):
         for obs in self.get_obstacles():
@@ -0,0 +1,94 @@
+import math
+import numpy as np
+
+from arena_map import ArenaMap
+from probalistic_motion import ParticleCloud, Position
+from raycast import MAX_READING
+
+GATE = 6.63  # 99% point of chi-square with one degree of freedom
+
+
+class EKFTracker:
+    """
+    Gaussian (x, y, theta) pose tracker for once the particle cloud has converged.
+
+    Uses the same motion model and e/f/g noise as Robot, and linearises the sonar
+    reading about the mean pose against whichever wall the beam hits there, so each
+    step costs the same however many particles the cloud had.
+    """
+
+    def __init__(self, mean: np.ndarray, cov: np.ndarray):
+        self.mean = np.array(mean, dtype=float)
+        self.cov = np.array(cov, dtype=float)
+        self.rejected = 0  # Readings in a row that failed the innovation gate
+
+    @classmethod
+    def from_cloud(cls, cloud: ParticleCloud) -> "EKFTracker":
+        estimate = cloud.estimate()
+        return cls(estimate.pose(), estimate.cov)
+
+    def converged(self, max_xy_sd: float, max_theta_sd: float) -> bool:
+        sd = np.sqrt(np.diag(self.cov))
+        return bool(sd[0] < max_xy_sd and sd[1] < max_xy_sd and sd[2] < max_theta_sd)
+
+    def predict_forward(self, D: float, e: float, f: float):
+        # Position.move_forward by D + N(0, e), then rotate by N(0, f)
+        x, y, theta = self.mean
+        c, s = math.cos(theta), math.sin(theta)
+        self.mean = np.array([x + c * D, y - s * D, theta])
+        F = np.array([[1, 0, -s * D], [0, 1, -c * D], [0, 0, 1]])
+        along = np.array([c, -s, 0])
+        self.cov = F @ self.cov @ F.T + e**2 * np.outer(along, along)
+        self.cov[2, 2] += f**2
+
+    def predict_rotate(self, angle: float, g: float):
+        self.mean[2] = Position.normalise(self.mean[2] + angle)
+        self.cov[2, 2] += g**2
+
+    def update(self, z: float, arena: ArenaMap, model, bearing: float = 0.0) -> bool:
+        """
+        Fold in a sonar reading, taken at bearing from the heading, using an
+        mcl.SonarModel's sigma and bias/scale.
+        Returns False once two readings in a row fall outside the innovation gate,
+        meaning the Gaussian has lost track and the particle filter should take over.
+        Max range readings, and poses where the beam expects one, are skipped.
+        """
+        x, y, theta = self.mean
+        c, s = math.cos(theta + bearing), math.sin(theta + bearing)
+        dists = arena.expected(x, y, c, s, np.arange(len(arena.segments)))
+        wall = int(np.argmin(dists))
+        dist = dists[wall]
+        if z >= MAX_READING or not dist < MAX_READING:
+            return True
+
+        # dist = n.(a - p) / n.b for wall normal n and beam direction b
+        n = arena.normals[wall]
+        facing = n[0] * c + n[1] * s
+        H = model.scale * np.array(
+            [-n[0] / facing, -n[1] / facing, -dist * (n[1] * c - n[0] * s) / facing]
+        )
+        innovation = z - (model.scale * dist + model.bias)
+        S = H @ self.cov @ H + model.sigma**2
+        if innovation**2 / S > GATE:
+            self.rejected += 1
+            return self.rejected < 2
+        self.rejected = 0
+
+        K = self.cov @ H / S
+        self.mean += K * innovation
+        self.mean[2] = Position.normalise(self.mean[2])
+        self.cov = (np.eye(3) - np.outer(K, H)) @ self.cov
+        return True
+
+    def sample(
+        self, n: int, rng: np.random.Generator, inflate: float = 4.0
+    ) -> ParticleCloud:
+        """
+        Particles drawn from the Gaussian, widened by `inflate` to cover what the
+        Gaussian missed when it lost track
+        """
+        x, y, theta = rng.multivariate_normal(self.mean, inflate * self.cov, n).T
+        return ParticleCloud(x, y, Position.normalise(theta), np.full(n, 1.0 / n))
+
+    def pose(self) -> tuple[float, float, float]:
+        return float(self.mean[0]), float(self.mean[1]), float(self.mean[2])
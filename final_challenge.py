@@ -1,5 +1,4 @@
-import motor_driver
-import brickpi3
+from probalistic_motion import Robot
 import time
 import sys
 
@@ -8,10 +7,8 @@ POWER = eval(" ".join(sys.argv[1:])) if len(sys.argv) > 1 else 100
 
 
 if __name__ == "__main__":
-    motorR = brickpi3.BrickPi3.PORT_B  # right motor
-    motorL = brickpi3.BrickPi3.PORT_C  # left motor
-    driver = motor_driver.MotorDriver(motorL=motorL, motorR=motorR)
-    driver.flipR = True
+    # Robot sets up its driver with the wheel calibration lane_change needs
+    driver = Robot(1).driver
     driver.lane_change()
     # for i in range(0, 255):
     #     print(i)
@@ -0,0 +1,64 @@
+import math
+
+import numpy as np
+
+from arena_map import ArenaMap
+
+
+def coarse_poses(arena: ArenaMap, xy_res: float, theta_res: float, clearance: float):
+    """
+    Every free cell centre of an xy_res grid over the arena, at every theta_res heading
+    """
+    xs = np.arange(arena.lo[0] + xy_res / 2, arena.hi[0], xy_res)
+    ys = np.arange(arena.lo[1] + xy_res / 2, arena.hi[1], xy_res)
+    x, y = (a.ravel() for a in np.meshgrid(xs, ys, indexing="ij"))
+    keep = arena.free(x, y, clearance)
+    x, y = x[keep], y[keep]
+    thetas = np.arange(-math.pi, math.pi, theta_res)
+    return np.repeat(x, len(thetas)), np.repeat(y, len(thetas)), np.tile(thetas, len(x))
+
+
+def search(
+    score,
+    arena: ArenaMap,
+    xy_res: float = 10.0,
+    theta_res: float = math.radians(10),
+    keep: int = 50,
+    levels: int = 3,
+    clearance: float = 5.0,
+    sigma: float = None,
+    shrink: float = 0.7,
+):
+    """
+    Coarse to fine search for the poses that best explain a set of readings.
+
+    score(x, y, theta, sigma) gives a log likelihood per pose, with readings taken to
+    be within about sigma cm of the truth. Every free pose on a coarse grid is scored,
+    then the best `keep` are refined `levels` times, each time scoring a 3x3x3
+    neighbourhood at half the previous spacing.
+    sigma starts at xy_res (None) and is multiplied by shrink at each level. A sigma
+    much tighter than the grid would rank the coarse poses on luck, and halving it
+    with the spacing loses the truth to the heading error left at each level.
+    Returns the best poses as an (keep, 3) array and their scores, best first.
+    """
+    sigma = sigma or xy_res
+    x, y, theta = coarse_poses(arena, xy_res, theta_res, clearance)
+    scores = score(x, y, theta, sigma)
+    best = np.argsort(scores)[::-1][:keep]
+    poses, scores = np.stack([x, y, theta], axis=1)[best], scores[best]
+
+    offsets = np.stack(
+        np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing="ij"), axis=-1
+    ).reshape(-1, 3)
+    step = np.array([xy_res, xy_res, theta_res])
+    for _ in range(levels):
+        step = step / 2
+        sigma = sigma * shrink
+        candidates = (poses[:, None, :] + offsets * step).reshape(-1, 3)
+        candidates[:, 2] = (candidates[:, 2] + math.pi) % (2 * math.pi) - math.pi
+        # Neighbouring hypotheses share candidates, only score those once
+        candidates = np.unique(candidates.round(6), axis=0)
+        candidate_scores = score(*candidates.T, sigma)
+        best = np.argsort(candidate_scores)[::-1][:keep]
+        poses, scores = candidates[best], candidate_scores[best]
+    return poses, scores
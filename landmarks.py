@@ -0,0 +1,61 @@
+import math
+from dataclasses import dataclass
+
+import numpy as np
+
+
+def relative_positions(x, y, theta, landmarks: np.ndarray):
+    """
+    Where each landmark is from each pose, as (forward, left) in cm, each (N, M).
+    Forward is the way Position.move_forward drives, (cos(theta), -sin(theta)), and
+    left is where it drives after a positive (left) quarter turn, (-sin(theta),
+    -cos(theta))
+    """
+    c, s = np.cos(theta)[:, None], np.sin(theta)[:, None]
+    dx = landmarks[:, 0] - np.asarray(x)[:, None]
+    dy = landmarks[:, 1] - np.asarray(y)[:, None]
+    return dx * c - dy * s, -(dx * s + dy * c)
+
+
+@dataclass
+class LandmarkModel:
+    """
+    Likelihood of camera blob sightings given the landmark points of an ArenaMap.
+
+    Sightings are ground plane (forward, left) points relative to the robot, what
+    columbussy.red_blobs gives. Blobs all look the same, so each is scored against
+    whichever landmark explains it best from that pose, and any blob may be a false
+    detection with probability z_false.
+    """
+
+    bearing_sd: float = math.radians(5)
+    range_sd: float = 2.0
+    range_frac: float = 0.1  # The homography gets worse further out
+    z_false: float = 0.1
+    max_range: float = 100.0
+
+    def log_likelihood(self, x, y, theta, sightings, landmarks) -> np.ndarray:
+        log_probs = np.zeros(len(x))
+        sightings = np.asarray(sightings, dtype=float).reshape(-1, 2)
+        if len(landmarks) == 0 or len(sightings) == 0:
+            return log_probs
+
+        forward, left = relative_positions(x, y, theta, landmarks)
+        expected_range = np.hypot(forward, left)
+        expected_bearing = np.arctan2(left, forward)
+        range_sd = self.range_sd + self.range_frac * expected_range
+        # Density of a false detection, spread over the camera's range and any bearing
+        log_false = math.log(self.z_false / (self.max_range * 2 * math.pi))
+
+        for f, l in sightings:
+            bearing_err = math.atan2(l, f) - expected_bearing
+            bearing_err = (bearing_err + math.pi) % (2 * math.pi) - math.pi
+            range_err = math.hypot(f, l) - expected_range
+            log_hit = (
+                -0.5 * (bearing_err / self.bearing_sd) ** 2
+                - 0.5 * (range_err / range_sd) ** 2
+                - np.log(2 * math.pi * self.bearing_sd * range_sd)
+            )
+            best = log_hit.max(axis=1) + math.log(1 - self.z_false)
+            log_probs += np.logaddexp(best, log_false)
+        return log_probs
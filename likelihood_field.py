@@ -0,0 +1,96 @@
+import hashlib
+import math
+import os
+
+import numpy as np
+
+from arena_map import ArenaMap
+from raycast import CACHE_DIR, MAX_READING
+
+
+class LikelihoodField:
+    """
+    Sonar model that skips ray casting: a grid of the distance from each point to the
+    nearest wall is computed once, then a reading z from (x, y, theta) is scored by
+    how close the end of the beam, (x + z cos(theta), y + z sin(theta)), is to a wall.
+
+    The grid covers the walls' bounding box plus a margin, and is cached under
+    CACHE_DIR next to the ray cast tables.
+    """
+
+    def __init__(self, field: np.ndarray, arena: ArenaMap, res: float, margin: float):
+        self.field = field
+        self.res = res
+        self.origin = arena.lo - margin
+        self.far = float(field.max())  # What endpoints off the grid count as
+
+    @staticmethod
+    def path(arena: ArenaMap, res: float, margin: float, cache_dir: str):
+        key = hashlib.sha1(b"likelihood_field")
+        key.update(arena.segments.astype(float).tobytes())
+        key.update(np.array([res, margin], dtype=float).tobytes())
+        return os.path.join(cache_dir, f"field-{key.hexdigest()[:16]}.npy")
+
+    @classmethod
+    def build(cls, arena: ArenaMap, res: float = 1.0, margin: float = 20.0):
+        origin = arena.lo - margin
+        nx, ny = np.floor((arena.hi + margin - origin) / res).astype(int) + 1
+        xs, ys = np.meshgrid(
+            origin[0] + res * np.arange(nx),
+            origin[1] + res * np.arange(ny),
+            indexing="ij",
+        )
+        points = np.stack([xs.ravel(), ys.ravel()], axis=1)
+        field = np.full(len(points), np.inf)
+        for wall in range(len(arena.segments)):
+            np.minimum(field, arena.point_distances(points, wall), out=field)
+        return cls(field.reshape(nx, ny).astype(np.float32), arena, res, margin)
+
+    @classmethod
+    def load(
+        cls,
+        arena: ArenaMap,
+        res: float = 1.0,
+        margin: float = 20.0,
+        cache_dir: str = CACHE_DIR,
+    ):
+        path = cls.path(arena, res, margin, cache_dir)
+        if not os.path.exists(path):
+            print("Building likelihood field", path)
+            field = cls.build(arena, res, margin).field
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, field)
+            os.replace(path + ".tmp", path)
+        return cls(np.load(path, mmap_mode="r"), arena, res, margin)
+
+    def distance(self, x, y) -> np.ndarray:
+        """
+        Distance from each point to the nearest wall, to the grid resolution
+        """
+        nx, ny = self.field.shape
+        i = np.rint((np.asarray(x) - self.origin[0]) / self.res).astype(int)
+        j = np.rint((np.asarray(y) - self.origin[1]) / self.res).astype(int)
+        inside = (i >= 0) & (i < nx) & (j >= 0) & (j < ny)
+        d = self.field[np.clip(i, 0, nx - 1), np.clip(j, 0, ny - 1)]
+        return np.where(inside, d, self.far)
+
+    def log_likelihood(self, x, y, theta, z, model) -> np.ndarray:
+        """
+        Log likelihood of readings z for each pose, with the hit/random weights,
+        sigma and bias/scale correction taken from an mcl.SonarModel.
+        Max range readings say nothing about where the walls are, so score 0.
+        """
+        log_probs = np.zeros(len(x))
+        c, s = np.cos(theta), np.sin(theta)
+        for reading in np.atleast_1d(z):
+            if reading >= MAX_READING:
+                continue
+            reading = (reading - model.bias) / model.scale
+            d = self.distance(x + reading * c, y + reading * s)
+            log_hit = (
+                math.log(model.z_hit / (model.sigma * math.sqrt(2 * math.pi)))
+                - 0.5 * (d / model.sigma) ** 2
+            )
+            log_probs += np.logaddexp(log_hit, math.log(model.z_rand / MAX_READING))
+        return log_probs
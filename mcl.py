@@ -1,17 +1,33 @@
 import math
-from time import sleep
+from time import monotonic, sleep
 
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Callable, Optional
 
 if TYPE_CHECKING:
     from typing import override
 else:
     override = lambda x: x
 from draw import draw_line, draw_cross
-from probalistic_motion import Robot
-from random import choices
+from probalistic_motion import (
+    NOISE_ANGLE,
+    NOISE_DISTANCE,
+    ParticleCloud,
+    Position,
+    Robot,
+)
+from dataclasses import dataclass, replace
+from statistics import NormalDist
 from copy import deepcopy
+import numpy as np
 import brickpi3
+import global_search
+import raycast
+from arena_map import ArenaMap
+from ekf import EKFTracker
+from landmarks import LandmarkModel
+from odometry import Odometry
+from likelihood_field import LikelihoodField
+from sonar import SonarService, hampel, measure
 import sys
 
 
@@ -30,119 +46,241 @@ WALLS = {
     "GH": [(210, 84), (210, 0)],
     "HO": [(210, 0), (0, 0)],
 }
+ARENA = ArenaMap(WALLS)
 
 SD = 0.75  # Standard deviation of the sonar sensor
 
-def angle_to_wall(theta):
-    theta = abs(theta)
-    if theta < math.pi / 2:
-        delta = theta
-    else:
-        delta = math.pi - theta
-    return delta
-
-
-def distance_to_wall(x: float, y: float, theta: float, wall: str) -> float:
-    # Get the start and end points of the wall
-    (ax, ay), (bx, by) = WALLS[wall]
-
-    c, s = math.cos(theta), math.sin(theta)
-
-    dist = ((by - ay) * (ax - x) - (bx - ax) * (ay - y)) / (
-        (by - ay) * c - (bx - ax) * s
-    )
-
-    int_x = x + dist * c
-    int_y = y + dist * s
-
-    # The wall is behind you, you should not be able to sense it
-    if dist < 0:
-        return float("inf")
-
-    if ax == bx:
-        if int_y < min(ay, by) or int_y > max(ay, by):
-            return float("inf")
-
-        # A vertical wall angle is just the same as rotating 90 and looking at a horizontal wall
-        if angle_to_wall(theta - math.pi / 4) < math.pi / 4:
-            return 255
-
-    else:
-        if int_x < min(ax, bx) or int_x > max(ax, bx):
-            return float("inf")
-
-        # Horizontal wall
-        # At very shallow angles, we want to
-        if angle_to_wall(theta) < math.pi / 4:
-            return 255
-
-    # Check if the intersection point is within the wall
-    # if (int_x - ax) * (int_x - bx) > 0 or (int_y - ay) * (int_y - by) > 0:
-    # return float("inf")
-
-    # uncertain angle
-    if dist > 185:
-        return 255
-
-    return dist
-
-def oblique_to_wall(x: float, y: float, theta: float, wall: str) -> float:
-    # Get the start and end points of the wall
-    (ax, ay), (bx, by) = WALLS[wall]
-
-    c, s = math.cos(theta), math.sin(theta)
-
-    dist = ((by - ay) * (ax - x) - (bx - ax) * (ay - y)) / (
-        (by - ay) * c - (bx - ax) * s
-    )
-
-    int_x = x + dist * c
-    int_y = y + dist * s
-
-    # The wall is behind you, you should not be able to sense it
-    assert dist >= 0, "Should not have negative dist in oblique targeting"
-
-
-    if ax == bx:
-        assert min(ay, by) <= int_y <= max(ay, by), "Should be pointing at wall in oblique targeting"
-        
-        # A vertical wall angle is just the same as rotating 90 and looking at a horizontal wall
-        if angle_to_wall(theta - math.pi / 4) < math.pi / 4:
-            return True
-
-    else:
-        assert min(ax, bx) <= int_x <= max(ax, bx), "Should be pointing at wall in oblique targeting"
-
-        # Horizontal wall
-        # At very shallow angles, we want to
-        if angle_to_wall(theta) < math.pi / 4:
-            return True
-
-    # Check if the intersection point is within the wall
-    # if (int_x - ax) * (int_x - bx) > 0 or (int_y - ay) * (int_y - by) > 0:
-        # return float("inf")
-
-    # uncertain angle
-    return False
-
-# x, y, theta: current position and orientation of the robot
-# z is the sonar measurement
-def calculate_likelihood(x, y, theta, z):
-    # Find which wall the sonar beam would hit to then use in calculation
-    dist, _ = min([(distance_to_wall(x, y, theta, wall), wall) for wall in WALLS])
-    # beta = math.acos(
-    #     (math.cos(theta) * (ay - by) + math.sin(theta) * (bx - ax)) /
-    #     (math.sqrt((ay - by)**2 + (bx - ax)**2))
-    # )
 
-    # TODO: Need to add reasonable constant
-    if dist > 1e9:
-        print("OUTSIDE: ", x, y, theta, z)
-    return dist, math.exp(-((z - dist) ** 2) / (2 * SD**2))
+def logsumexp(a: np.ndarray) -> float:
+    m = a.max()
+    if not np.isfinite(m):
+        return m
+    return m + math.log(np.sum(np.exp(a - m)))
+
+
+@dataclass
+class SonarModel:
+    """
+    Log likelihood of sonar readings given the expected reading, as a mixture of
+    - a Gaussian around the expected reading, after correcting for the sensor's
+      systematic error (reading ~ scale * distance + bias). A least squares fit of
+      sensor_findings.md gives raw = 1.02 * d + 2.0 from the sensor, and readings
+      and expected distances are both from the centre, 5cm further back, so
+      reading = 1.02 * (expected - 5) + 2.0 + 5 = 1.02 * expected + 1.9
+    - a uniform term for the ~10% of garbage readings
+    - a point mass at 255 for when the echo never comes back
+    Readings from the same pose are fused by adding their log likelihoods.
+    """
+
+    sigma: float = SD
+    scale: float = 1.02
+    bias: float = 1.9
+    z_hit: float = 0.85
+    z_rand: float = 0.1
+    z_max: float = 0.05
+
+    def log_likelihood(self, expected: np.ndarray, z) -> np.ndarray:
+        """
+        expected is either one reading per particle, with z one or more readings
+        from that pose, or (particles, beams) with z one reading per beam
+        """
+        z = np.atleast_1d(np.asarray(z, dtype=float))
+        if expected.ndim == 1:
+            expected = expected[:, None]
+        predicted = self.scale * expected + self.bias
+        with np.errstate(invalid="ignore", divide="ignore"):
+            log_hit = (
+                math.log(self.z_hit / (self.sigma * math.sqrt(2 * math.pi)))
+                - 0.5 * ((z - predicted) / self.sigma) ** 2
+            )
+            log_hit = np.where(np.isfinite(expected), log_hit, -np.inf)
+            log_rand = math.log(self.z_rand / raycast.MAX_READING)
+            log_max = np.where(z >= raycast.MAX_READING, math.log(self.z_max), -np.inf)
+        return np.logaddexp(np.logaddexp(log_hit, log_rand), log_max).sum(axis=1)
+
+
+def effective_sample_size(weights: np.ndarray) -> float:
+    # Equals the particle count for uniform weights, 1 when one particle has it all
+    return 1.0 / np.sum(weights**2)
+
+
+# Resamplers take normalised weights and return the indices of the n particles to keep
+
+
+def systematic_resample(weights: np.ndarray, n: int, rng: np.random.Generator):
+    # Low variance resampling: one random offset, then n evenly spaced pointers
+    positions = (rng.random() + np.arange(n)) / n
+    cumulative = np.cumsum(weights)
+    cumulative[-1] = 1.0  # Guard against rounding leaving the last pointer unmatched
+    return np.searchsorted(cumulative, positions, side="right")
+
+
+def residual_resample(weights: np.ndarray, n: int, rng: np.random.Generator):
+    # Deterministically keep floor(n * w) copies of each, then fill the rest systematically
+    copies = np.floor(n * weights).astype(int)
+    idx = np.repeat(np.arange(len(weights)), copies)
+    remaining = n - len(idx)
+    if remaining == 0:
+        return idx
+    residuals = n * weights - copies
+    residuals /= residuals.sum()
+    return np.concatenate([idx, systematic_resample(residuals, remaining, rng)])
+
+
+@dataclass
+class KLDSampling:
+    """
+    KLD-sampling (Fox, 2003): after resampling, keep just enough particles that the
+    cloud is within epsilon (KL divergence) of the posterior with probability
+    1 - delta, judged by how many (x, y, theta) bins the particles occupy.
+
+    Also tracks short and long term averages of the sensor likelihood (augmented
+    MCL), and scatters that fraction of particles over the map when readings get
+    worse than usual, which spreads the cloud and so grows it after a kidnapping.
+    About 10% of sonar readings are garbage (sensor_findings.md), so it only does
+    once `patience` readings in a row have come in under `drop` of the long term
+    average, not on one bad reading.
+    """
+
+    min_particles: int = 20
+    max_particles: int = 5000
+    epsilon: float = 0.05
+    delta: float = 0.01
+    bin_size: tuple[float, float, float] = (10, 10, math.radians(10))
+    alpha_slow: float = 0.01
+    alpha_fast: float = 0.5
+    patience: int = 3
+    drop: float = 0.1
+    w_slow: float = 0.0
+    w_fast: float = 0.0
+    streak: int = 0  # Readings in a row under drop * w_slow
+
+    def bound(self, k: np.ndarray) -> np.ndarray:
+        # Wilson-Hilferty approximation of the chi-square quantile, k occupied bins
+        z = NormalDist().inv_cdf(1 - self.delta)
+        k = np.maximum(k - 1, 1)
+        a = 2 / (9 * k)
+        return k / (2 * self.epsilon) * (1 - a + np.sqrt(a) * z) ** 3
+
+    def particle_count(self, x, y, theta) -> int:
+        """
+        Smallest prefix of the (randomly ordered) draws that satisfies the bound
+        """
+        bins = np.floor(np.stack([x, y, theta]).T / self.bin_size).astype(int)
+        bins -= bins.min(axis=0)
+        keys = np.ravel_multi_index(bins.T, bins.max(axis=0) + 1)
+        _, first = np.unique(keys, return_index=True)
+        new_bin = np.zeros(len(keys), dtype=bool)
+        new_bin[first] = True
+        m = np.arange(1, len(keys) + 1)
+        enough = (m >= self.bound(np.cumsum(new_bin))) & (m >= self.min_particles)
+        return int(np.argmax(enough)) + 1 if enough.any() else len(keys)
+
+    def recovery_fraction(self, w_avg: float) -> float:
+        if self.w_slow == 0:
+            self.w_slow = self.w_fast = w_avg
+        self.w_slow += self.alpha_slow * (w_avg - self.w_slow)
+        self.w_fast += self.alpha_fast * (w_avg - self.w_fast)
+        self.streak = self.streak + 1 if w_avg < self.drop * self.w_slow else 0
+        if self.streak < self.patience:
+            return 0.0
+        return max(0.0, 1 - self.w_fast / self.w_slow)
 
 
 class NormRobot(Robot):
+    def __init__(
+        self,
+        *args,
+        use_table: bool = False,
+        use_field: bool = False,
+        global_init: bool = False,
+        wall_motion: Optional[str] = "kill",
+        resampler=systematic_resample,
+        resample_threshold: float = 0.5,
+        kld: Optional[KLDSampling] = None,
+        sonar_model: Optional[SonarModel] = None,
+        background_sonar: bool = False,
+        adaptive_sonar: bool = False,
+        arena: Optional[ArenaMap] = None,
+        ekf_tracking: bool = False,
+        ekf_xy_sd: float = 3.0,
+        ekf_theta_sd: float = math.radians(5),
+        multimodal: Optional[str] = None,
+        camera: Optional[Callable] = None,
+        landmark_model: Optional[LandmarkModel] = None,
+        **kwargs,
+    ):
+        """
+        use_table: look expected readings up in a precomputed raycast.RaycastTable
+        use_field: score readings with a likelihood_field.LikelihoodField instead of
+        ray casting
+        global_init: start with the particles spread over the whole map rather than
+        at the start pose (see also global_localise)
+        wall_motion: what happens to particles whose move crosses a wall, "kill"
+        zeroes their weight, "reflect" bounces them off it, None ignores walls
+        resample_threshold: resample only once the effective sample size drops below
+        this fraction of the particle count, otherwise the weights carry over
+        kld: adapt the particle count on every resample instead of keeping it fixed
+        background_sonar: poll the sonar continuously in a sonar.SonarService thread
+        adaptive_sonar: stop sampling once a few readings agree (sonar.measure),
+        the number of samples each reading took is kept in self.sonar_samples
+        arena: the map to localise in, mcl.WALLS by default
+        ekf_tracking: once the cloud's standard deviations drop below ekf_xy_sd and
+        ekf_theta_sd, track the pose with an ekf.EKFTracker instead, going back to a
+        cloud drawn around it when the readings stop agreeing with it
+        multimodal: what to navigate from when the cloud has split, None uses the
+        mean of the whole cloud, "best" the heaviest hypothesis, and "wait" turns on
+        the spot taking readings until one hypothesis clearly wins (disambiguate)
+        camera: called on every update for the ground plane (forward, left) blobs in
+        view, e.g. lambda: columbussy.red_blobs(picam2.capture_array()), which are
+        matched against the arena's landmarks before the sonar reading is taken
+        """
+        super().__init__(*args, **kwargs)
+        self.arena = arena or ARENA
+        self.table = raycast.RaycastTable.load(self.arena) if use_table else None
+        self.field = LikelihoodField.load(self.arena) if use_field else None
+        self.wall_motion = wall_motion
+        if global_init:
+            n = len(self.particle_cloud)
+            self.particle_cloud = ParticleCloud(
+                *self.arena.random_free_poses(n, self.rng), np.full(n, 1.0 / n)
+            )
+        self.resampler = resampler
+        self.resample_threshold = resample_threshold
+        self.kld = kld
+        self.sonar_model = sonar_model or SonarModel()
+        self.sonar = (
+            SonarService(self.driver.BP, self.driver.sensor)
+            if background_sonar
+            else None
+        )
+        self.adaptive_sonar = adaptive_sonar
+        self.sonar_samples: list[int] = []
+        self.ekf_tracking = ekf_tracking
+        self.ekf_xy_sd = ekf_xy_sd
+        self.ekf_theta_sd = ekf_theta_sd
+        self.ekf: Optional[EKFTracker] = None
+        self.multimodal = multimodal
+        self.camera = camera
+        self.landmark_model = landmark_model or LandmarkModel()
+
     def sensor_reading(self) -> float:
+        if self.sonar is not None:
+            # Give the sampler one window of readings taken after stopping
+            t = monotonic()
+            sleep(self.sonar.window * self.sonar.period)
+            z = hampel(self.sonar.since(t)[1])
+            if z is not None:
+                print("sensor reading=", z)
+                return z
+
+        if self.adaptive_sonar:
+            z, samples = measure(self.driver.read_sensor)
+            if z is not None:
+                self.sonar_samples.append(samples)
+                print(f"sensor reading= {z} ({samples} samples)")
+                return z
+
         readings = []
         while len(readings) < 20:
             x = self.driver.read_sensor()
@@ -153,36 +291,329 @@ class NormRobot(Robot):
         print("sensor reading=", readings[10])
         return readings[10]
 
-    def normalise_probs(self, z):
-        probs, dists = [], []
+    @override
+    def getMeanPos(self, mode: bool = False):
+        if self.ekf is not None:
+            return self.ekf.pose()
+        if self.multimodal is not None:
+            hypotheses = self.particle_cloud.hypotheses()
+            if hypotheses:
+                return hypotheses[0].pose()
+        return super().getMeanPos(mode)
+
+    # Disambiguating turns the robot, so it has to happen before each leg works out
+    # how far to turn, not in getTargeting, which is asked again after the turn
+    @override
+    def navigateToWaypoint(self, x, y, i=20):
+        if self.multimodal == "wait":
+            self.disambiguate()
+        super().navigateToWaypoint(x, y, i)
+
+    @override
+    def navigateToWaypointArc(self, x, y, i=20):
+        if self.multimodal == "wait":
+            self.disambiguate()
+        super().navigateToWaypointArc(x, y, i)
+
+    def disambiguate(self, steps: int = 8, share: float = 0.8) -> bool:
+        """
+        Turn on the spot a 1/steps of a turn at a time, taking a reading after each,
+        until the best hypothesis holds `share` of the weight of all of them.
+        Gives up after a full turn, returning whether it got there
+        """
+        for _ in range(steps):
+            if self.ekf is not None:
+                return True
+            hypotheses = self.particle_cloud.hypotheses()
+            best = hypotheses[0].weight if hypotheses else 0
+            if best > 0 and best >= share * sum(h.weight for h in hypotheses):
+                return True
+            print(f"{len(hypotheses)} hypotheses, turning to tell them apart")
+            self.rotate(2 * math.pi / steps)
+        return False
+
+    @override
+    def predict_forward(self, D, noise=1.0):
+        if self.ekf is not None:
+            self.ekf.predict_forward(D, self.e * noise, self.f * noise)
+            return
+        cloud = self.particle_cloud
+        x0, y0 = cloud.x.copy(), cloud.y.copy()
+        super().predict_forward(D, noise)
+        self.check_walls(x0, y0)
+
+    @override
+    def predict_arc(self, distance, turn, noise=1.0):
+        if self.ekf is not None:
+            # An arc is its chord, heading halfway round the turn
+            chord = distance if turn == 0 else 2 * distance / turn * math.sin(turn / 2)
+            scale = noise * math.sqrt(abs(distance) / NOISE_DISTANCE)
+            self.ekf.predict_rotate(turn / 2, 0.0)
+            self.ekf.predict_forward(chord, self.e * scale, self.f * scale)
+            turn_sd = self.g * noise * math.sqrt(abs(turn) / NOISE_ANGLE)
+            self.ekf.predict_rotate(turn / 2, turn_sd)
+            return
+        cloud = self.particle_cloud
+        x0, y0 = cloud.x.copy(), cloud.y.copy()
+        super().predict_arc(distance, turn, noise)
+        # Only the chord is checked, near enough for the arcs a waypoint takes
+        self.check_walls(x0, y0)
+
+    def check_walls(self, x0, y0):
+        """
+        Deal with the particles that went through a wall getting from (x0, y0) to
+        where they are now, as wall_motion says
+        """
+        cloud = self.particle_cloud
+        if self.wall_motion is None:
+            return
+        t, walls = self.arena.crossings(x0, y0, cloud.x, cloud.y)
+        crossed = np.isfinite(t)
+        if not crossed.any():
+            return
+        print(f"{np.count_nonzero(crossed)} particles went through a wall")
+        if self.wall_motion == "reflect":
+            cloud.x[crossed], cloud.y[crossed] = self.arena.reflect(
+                cloud.x[crossed], cloud.y[crossed], walls[crossed]
+            )
+        elif cloud.weight[~crossed].sum() > 0:
+            # If every particle with any weight did, it's the map that's wrong
+            cloud.weight[crossed] = 0
+            cloud.weight[:] /= cloud.weight.sum()
+        cloud.changed()
+
+    @override
+    def predict_rotate(self, angle, noise=1.0):
+        if self.ekf is not None:
+            self.ekf.predict_rotate(angle, self.g * noise)
+            return
+        super().predict_rotate(angle, noise)
 
-        for p in self.particle_cloud:
-            dist, prob = calculate_likelihood(p.pos.x, p.pos.y, p.pos.theta, z)
-            dists.append(dist)
-            probs.append(prob + 0.01)  # Baseline 1% error rate
+    def expected_ranges(self, x, y, theta) -> np.ndarray:
+        if self.table is not None:
+            return self.table.lookup(x, y, theta, interpolate=True)
+        return self.arena.cast(x, y, theta)
 
-        print("average expected dist", sum(dists) / len(dists))
-        total = sum(probs)
-        likelihoods = [l / total for l in probs]
+    def normalise_probs(self, z):
+        """
+        Weight the cloud by a sonar reading z (or several from the same pose)
+        """
+        if self.ekf is not None:
+            self.track([(0.0, reading) for reading in np.atleast_1d(z)])
+            return
+        cloud = self.particle_cloud
+        self.apply_log_likelihood(self.log_likelihood(cloud.x, cloud.y, cloud.theta, z))
+        if self.ekf_tracking:
+            ekf = EKFTracker.from_cloud(self.particle_cloud)
+            if ekf.converged(self.ekf_xy_sd, self.ekf_theta_sd):
+                print("cloud converged, tracking with the EKF from", ekf.pose())
+                self.ekf = ekf
+
+    def track(self, readings: list[tuple[float, float]]):
+        for bearing, z in readings:
+            if not self.ekf.update(z, self.arena, self.sonar_model, bearing):
+                print("EKF lost track at", self.ekf.pose(), "back to particles")
+                self.set_cloud(self.ekf.sample(len(self.particle_cloud), self.rng))
+                self.ekf = None
+                return
+
+    def log_likelihood(self, x, y, theta, z) -> np.ndarray:
+        """
+        Log likelihood of reading(s) z from each pose under the chosen sensor model
+        """
+        if self.field is not None:
+            return self.field.log_likelihood(x, y, theta, z, self.sonar_model)
+        return self.sonar_model.log_likelihood(self.expected_ranges(x, y, theta), z)
+
+    def spin_readings(self, steps: int = 8) -> list[tuple[float, float]]:
+        """
+        Turn a full circle on the spot, reading the sonar every 1/steps of a turn.
+        Returns (bearing from the starting heading, reading) pairs
+        """
+        angle = 2 * math.pi / steps
+        readings = []
+        for k in range(steps):
+            readings.append((k * angle, self.sensor_reading()))
+            self.driver.rotate(angle * self.TURN_SCALING)
+        return readings
+
+    def global_localise(self, steps: int = 8, **search_kwargs):
+        """
+        Find the robot from scratch: spin to take readings all round, search the map
+        for the poses that explain them (global_search.search), and reseed the cloud
+        around the best of those
+        """
+        readings = self.spin_readings(steps)
+
+        def score(x, y, theta, sigma):
+            # No tighter than the sensor itself by the last level
+            model = replace(self.sonar_model, sigma=max(sigma, self.sonar_model.sigma))
+            return self.scan_log_likelihood(x, y, theta, readings, model)
+
+        poses, scores = global_search.search(score, self.arena, **search_kwargs)
+        print("best global poses", poses[:3].round(2), "scores", scores[:3].round(2))
+
+        # After the full turn the robot is facing the way it started
+        n = len(self.particle_cloud)
+        picks = self.rng.choice(len(poses), n, p=np.exp(scores - logsumexp(scores)))
+        x, y, theta = poses[picks].T + self.rng.normal(
+            0, [[2], [2], [math.radians(2)]], (3, n)
+        )
+        self.set_cloud(
+            ParticleCloud(x, y, Position.normalise(theta), np.full(n, 1.0 / n))
+        )
+        super().update()
+
+    def sweep_readings(
+        self, steps: int = 16
+    ) -> tuple[list[tuple[float, float]], float]:
+        """
+        Turn a full circle without stopping, reading the sonar each time the wheel
+        encoders say the robot has turned another 1/steps of a turn.
+        Returns (bearing from the starting heading, reading) pairs and how far the
+        encoders say it turned in all
+        """
+        sweep = Odometry(
+            1 / (360 * self.FWD_SCALING),
+            1 / (360 * self.TURN_SCALING),
+            self.driver.flipL,
+            self.driver.flipR,
+        )
+        readings = []
+        spacing = 2 * math.pi / steps
+
+        def on_encoders(left, right):
+            sweep.update(left, right)
+            if len(readings) < steps and sweep.turn >= len(readings) * spacing:
+                z = self.driver.read_sensor()
+                if z is not None:
+                    readings.append((sweep.turn, z))
+
+        self.driver.listeners.append(on_encoders)
+        try:
+            self.driver.rotate(2 * math.pi * self.TURN_SCALING)
+        finally:
+            self.driver.listeners.remove(on_encoders)
+        return readings, sweep.turn
+
+    def scan(self, steps: int = 16, continuous: bool = True):
+        """
+        Turn a full circle taking readings all round, then weight the cloud by all
+        of them at once. continuous reads on the move (sweep_readings), otherwise
+        the robot stops for each reading (spin_readings)
+        """
+        if continuous:
+            readings, turn = self.sweep_readings(steps)
+        else:
+            readings, turn = self.spin_readings(steps), 2 * math.pi
+        if self.odometry is None:
+            self.predict_motion(0, turn)
+        else:
+            self.predict_motion(*self.odometry.take())
+        print(f"scan of {len(readings)} readings over {math.degrees(turn):.0f} degrees")
+        # Bearings from where the robot is facing now, at the end of the turn
+        self.scan_update([(bearing - turn, z) for bearing, z in readings])
+        super().update()
 
-        p_probs = choices(
-            list(zip(self.particle_cloud.particles, likelihoods)),
-            likelihoods,
-            k=len(self.particle_cloud.particles),
+    def scan_update(self, readings: list[tuple[float, float]]):
+        """
+        Weight the cloud by readings taken at several bearings from the current
+        heading, e.g. from a scan or a sonar on a turntable
+        """
+        if self.ekf is not None:
+            self.track(readings)
+            return
+        cloud = self.particle_cloud
+        self.apply_log_likelihood(
+            self.scan_log_likelihood(cloud.x, cloud.y, cloud.theta, readings)
         )
-        total = sum(prob for (_, prob) in p_probs)
 
-        self.particle_cloud.particles = [
-            p.clone_with_weight(prob / total) for p, prob in p_probs
-        ]
-        total_p = sum(p.weight for p in self.particle_cloud.particles)
+    def scan_log_likelihood(self, x, y, theta, readings, model=None) -> np.ndarray:
+        """
+        Log likelihood of (bearing, reading) pairs from each pose, with every
+        bearing ray cast in one go as a column of a (poses, bearings) matrix.
+        model defaults to self.sonar_model
+        """
+        model = model or self.sonar_model
+        if self.field is not None:
+            return sum(
+                self.field.log_likelihood(x, y, theta + bearing, z, model)
+                for bearing, z in readings
+            )
+        bearings, z = np.array(readings, dtype=float).reshape(-1, 2).T
+        beams = Position.normalise(np.asarray(theta)[:, None] + bearings)
+        n, k = beams.shape
+        expected = self.expected_ranges(
+            np.repeat(x, k), np.repeat(y, k), beams.ravel()
+        ).reshape(n, k)
+        return model.log_likelihood(expected, z)
+
+    def apply_log_likelihood(self, log_probs: np.ndarray):
+        """
+        Multiply per particle likelihoods (given as logs) into the weights, then
+        resample if needed
+        """
+        cloud = self.particle_cloud
+        with np.errstate(divide="ignore"):
+            log_w = np.log(cloud.weight) + log_probs
+        log_total = logsumexp(log_w)
+        cloud.weight[:] = np.exp(log_w - log_total)
+        cloud.changed()
+
+        n = len(cloud)
+        ess = effective_sample_size(cloud.weight)
+        if self.kld is not None:
+            recover = self.kld.recovery_fraction(math.exp(log_total))
+            if ess < self.resample_threshold * n or recover > 0.1:
+                self.kld_resample(recover)
+        elif ess < self.resample_threshold * n:
+            print(f"resampling, effective sample size {ess:.0f}/{n}")
+            self.resample(self.resampler(cloud.weight, n, self.rng))
+        total_p = self.particle_cloud.weight.sum()
         assert abs(total_p - 1) < 0.001, f"probs should sum to 1, not {total_p}"
 
+    def resample(self, idx: np.ndarray):
+        self.particle_cloud.resample(idx)
+
+    def set_cloud(self, cloud: ParticleCloud):
+        # Anything replacing the whole cloud goes through here, see ShardedRobot
+        self.particle_cloud = cloud
+
+    def kld_resample(self, recover: float):
+        cloud = self.particle_cloud
+        # Draw the largest allowed cloud in random order, then keep the shortest
+        # prefix that covers enough bins
+        idx = self.resampler(cloud.weight, self.kld.max_particles, self.rng)
+        idx = self.rng.permutation(idx)
+        x, y, theta = cloud.x[idx], cloud.y[idx], cloud.theta[idx]
+        scatter = self.rng.random(len(idx)) < recover
+        x[scatter], y[scatter], theta[scatter] = self.arena.random_free_poses(
+            np.count_nonzero(scatter), self.rng
+        )
+        n = self.kld.particle_count(x, y, theta)
+        print(f"KLD resampling {len(cloud)} -> {n} particles, {recover:.0%} scattered")
+        self.set_cloud(ParticleCloud(x[:n], y[:n], theta[:n], np.full(n, 1.0 / n)))
+
     @override
     def update(self):
+        if self.camera is not None:
+            self.observe_landmarks(list(self.camera()))
         self.normalise_probs(self.sensor_reading())
         super().update()
 
+    def observe_landmarks(self, sightings):
+        """
+        Weight the cloud by blobs seen by the camera, as (forward, left) points
+        """
+        if not sightings or self.ekf is not None:
+            return
+        cloud = self.particle_cloud
+        self.apply_log_likelihood(
+            self.landmark_model.log_likelihood(
+                cloud.x, cloud.y, cloud.theta, sightings, self.arena.landmark_points
+            )
+        )
+
 
 if __name__ == "__main__":
     if VISUALISATION:
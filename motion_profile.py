@@ -0,0 +1,65 @@
+import math
+
+import numpy as np
+
+
+class Profile:
+    """
+    Position and velocity against time for a move of some distance, tabulated every
+    dt and interpolated in between. Units are whatever the distance is in (wheel
+    degrees for MotorDriver) per second.
+    """
+
+    def __init__(self, t: np.ndarray, s: np.ndarray, v: np.ndarray):
+        self.t = t
+        self.s = s
+        self.v = v
+        self.duration = float(t[-1])
+        self.distance = float(s[-1])
+
+    def at(self, t: float) -> tuple[float, float]:
+        return float(np.interp(t, self.t, self.s)), float(np.interp(t, self.t, self.v))
+
+
+def trapezoid(distance: float, v_max: float, a_max: float, dt: float = 0.001):
+    """
+    Accelerate at a_max up to v_max, cruise, and decelerate to stop at distance.
+    Short moves never reach v_max and are triangular instead
+    """
+    distance = abs(distance)
+    v_peak = min(v_max, math.sqrt(distance * a_max))
+    t_acc = v_peak / a_max if v_peak else 0.0
+    t_cruise = (distance - v_peak * t_acc) / v_peak if v_peak else 0.0
+    duration = 2 * t_acc + t_cruise
+    t = np.arange(0, duration + dt, dt)
+    v = np.minimum.reduce(
+        [
+            np.full_like(t, v_peak),
+            a_max * t,
+            np.maximum(0, a_max * (duration - t)),
+        ]
+    )
+    return from_velocity(t, v, distance)
+
+
+def s_curve(
+    distance: float, v_max: float, a_max: float, j_max: float, dt: float = 0.001
+):
+    """
+    A trapezoid with the corners rounded so acceleration ramps at no more than j_max,
+    by averaging its velocity over a window of a_max / j_max
+    """
+    profile = trapezoid(distance, v_max, a_max, dt)
+    window = max(1, int(round(a_max / j_max / dt)))
+    v = np.convolve(profile.v, np.full(window, 1.0 / window))
+    t = np.arange(len(v)) * dt
+    return from_velocity(t, v, abs(distance))
+
+
+def from_velocity(t: np.ndarray, v: np.ndarray, distance: float) -> Profile:
+    # Integrate, then rescale the small discretisation error so it ends on distance
+    s = np.concatenate([[0.0], np.cumsum((v[1:] + v[:-1]) / 2 * np.diff(t))])
+    if s[-1] > 0:
+        scale = distance / s[-1]
+        s, v = s * scale, v * scale
+    return Profile(t, s, v)
@@ -1,6 +1,8 @@
 import atexit
-import time
+import math
 import brickpi3
+from cached_brickpi import CachedBrickPi3
+from wheel_control import DPS_PER_POWER, FirmwareController, WheelController
 
 import sys
 
@@ -8,15 +10,49 @@ SCALE = eval(" ".join(sys.argv[1:])) if len(sys.argv) > 1 else 10
 
 
 class MotorDriver:
-    def __init__(self, motorL, motorR, scale=1):
+    def __init__(
+        self,
+        motorL,
+        motorR,
+        scale=1,
+        control_rate=50.0,
+        backend="pid",
+        rotations_per_cm=None,
+        wheel_base=None,
+        bp=None,
+    ):
+        """
+        backend: "pid" closes the loop here at control_rate, "firmware" leaves it to
+        the BrickPi3's position control and only polls for when the move is done
+        rotations_per_cm, wheel_base (cm): the geometry drive_arc and drive_twist
+        need, Robot fills these in from its calibration
+        bp: the BrickPi3 to drive, the real one by default (sim_brickpi.SimBrickPi3
+        to run without the robot)
+        """
         self.SCALE = scale
-        self.BP = brickpi3.BrickPi3()
+        self.BP = CachedBrickPi3(bp)
         atexit.register(self.BP.reset_all)
         self.motorL = motorL
         self.motorR = motorR
         self.flipL = self.flipR = False
         self.sensor = self.BP.PORT_1
         self.BP.set_sensor_type(self.sensor, self.BP.SENSOR_TYPE.NXT_ULTRASONIC)
+        # What the encoders read before each reset, so listeners get a running total
+        self.encoder_base = [0, 0]
+        # Called with the raw (unflipped) running encoder totals on every read
+        self.listeners = []
+        self.rotations_per_cm = rotations_per_cm
+        self.wheel_base = wheel_base
+        if backend == "firmware":
+            self.controller = FirmwareController(self)
+        else:
+            self.controller = WheelController(self, control_rate)
+
+    def reset_encoders(self):
+        motors = (self.motorL, self.motorR)
+        for i, (motor, position) in enumerate(zip(motors, self.BP.read_many(motors))):
+            self.BP.offset_motor_encoder(motor, position)
+            self.encoder_base[i] += position
 
     def read_left(self):
         res = self.BP.get_motor_encoder(self.motorL)
@@ -31,7 +67,15 @@ class MotorDriver:
         return res
 
     def read(self):
-        return self.read_left(), self.read_right()
+        raw_l, raw_r = self.BP.read_many((self.motorL, self.motorR))
+        if self.listeners:
+            self.notify(raw_l, raw_r)
+        return -raw_l if self.flipL else raw_l, -raw_r if self.flipR else raw_r
+
+    def notify(self, raw_l, raw_r):
+        # Encoders as read since the last reset, unflipped
+        for listener in self.listeners:
+            listener(self.encoder_base[0] + raw_l, self.encoder_base[1] + raw_r)
 
     def read_sensor(self):
         try:
@@ -55,34 +99,9 @@ class MotorDriver:
         """
         Move the robot forward by a distance dist (in rotations)
         """
-        self.BP.offset_motor_encoder(
-            self.motorL, self.BP.get_motor_encoder(self.motorL)
-        )
-        self.BP.offset_motor_encoder(
-            self.motorR, self.BP.get_motor_encoder(self.motorR)
-        )
-
-        targetL = 360 * dist
-        targetR = 360 * dist
-
-        self.write_left(20 * self.SCALE)
-        self.write_right(20 * self.SCALE)
-
-        l, r = self.read()
-        t = time.time()
-        while l < targetL or r < targetR:
-            if l < targetL and r < targetR and time.time() - t > 0.4:
-                ratio = (l - r) / 10
-                print(ratio)
-                self.write_left(min(100, (20 - ratio) * self.SCALE))
-                self.write_right(min(100, (20 + ratio) * self.SCALE))
-                t = time.time()
-
-            l, r = self.read()
-            if l >= targetL:
-                self.write_left(0)
-            if r >= targetR:
-                self.write_right(0)
+        self.controller.run(360 * dist, 360 * dist, 20 * self.SCALE)
+        print(self.controller.timer.summary())
+        print(self.BP.summary())
 
     def rotate(self, angle: float):
         """
@@ -97,48 +116,53 @@ class MotorDriver:
             self.move_forward(angle)
             self.flipL = not self.flipL
 
-    def gradual_rotate(self, right: bool, dist: float = 10):
+    def gradual_rotate(self, right: bool, radius: float, angle: float, power=None):
+        """
+        Curve right or left by angle (radians) around a circle of radius (cm)
+        """
+        self.drive_arc(-radius if right else radius, radius * angle, power)
 
+    def arc_targets(self, distance: float, turn: float) -> tuple[float, float]:
         """
-        Move the robot forward by a distance dist (in rotations)
+        Wheel encoder targets (degrees) for the centre of the robot to travel
+        distance cm while turning by turn radians (positive as in rotate)
         """
-        diff_factor = 1.5
-        speed = 50
+        half = self.wheel_base / 2
+        degrees = 360 * self.rotations_per_cm
+        return (distance - turn * half) * degrees, (distance + turn * half) * degrees
 
-        self.BP.offset_motor_encoder(
-            self.motorL, self.BP.get_motor_encoder(self.motorL)
-        )
-        self.BP.offset_motor_encoder(
-            self.motorR, self.BP.get_motor_encoder(self.motorR)
+    def drive_arc(self, radius: float, arc_length: float, power=None):
+        """
+        Drive arc_length cm around a circle of the given radius (cm), curving the
+        way a positive rotate turns for a positive radius, straight for inf
+        """
+        turn = 0.0 if math.isinf(radius) else arc_length / radius
+        self.controller.run(
+            *self.arc_targets(arc_length, turn), power or 20 * self.SCALE
         )
+        print(self.controller.timer.summary())
+        print(self.BP.summary())
 
-        if right:
-            targetL = 360 * dist * diff_factor
-            targetR = 360 * dist
-            self.write_left(speed * self.SCALE * diff_factor)
-            self.write_right(speed * self.SCALE)
-        else:
-            targetL = 360 * dist
-            targetR = 360 * dist * diff_factor
-            self.write_left(speed * self.SCALE)
-            self.write_right(speed * self.SCALE * diff_factor)
-
-        l, r = self.read()
-        t = time.time()
-        while l < targetL or r < targetR:
-            if l < targetL and r < targetR and time.time() - t > 0.4:
-                ratio = (l - r) / 10
-                print(ratio)
-                self.write_left((speed - ratio) * self.SCALE)
-                self.write_right((speed + ratio) * self.SCALE)
-                t = time.time()
-
-            l, r = self.read()
-            if l >= targetL:
-                self.write_left(0)
-            if r >= targetR:
-                self.write_right(0)
-
-    def lane_change(self):
-        self.gradual_rotate(True)
-        self.gradual_rotate(False)
+    def drive_twist(self, v: float, omega: float, duration: float):
+        """
+        Drive at v cm/s while turning at omega rad/s for duration seconds (a little
+        longer, with the speeding up and slowing down at either end)
+        """
+        if duration <= 0:
+            raise ValueError(f"drive_twist needs a positive duration, not {duration}")
+        targetL, targetR = self.arc_targets(v * duration, omega * duration)
+        # Power for the faster wheel to cover its distance in that time
+        power = max(abs(targetL), abs(targetR)) / duration / DPS_PER_POWER
+        self.controller.run(targetL, targetR, min(100.0, power))
+        print(self.controller.timer.summary())
+        print(self.BP.summary())
+
+    def lane_change(self, width: float = 30, length: float = 80, power=None):
+        """
+        Move width cm to the right over length cm forward, as two opposite arcs
+        """
+        # Each arc covers half of both, and turns twice the angle of its chord
+        angle = 2 * math.atan2(width, length)
+        radius = math.hypot(width, length) / 4 / math.sin(angle / 2)
+        self.gradual_rotate(True, radius, angle, power)
+        self.gradual_rotate(False, radius, angle, power)
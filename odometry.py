@@ -0,0 +1,52 @@
+import math
+
+
+class Odometry:
+    """
+    Turns running wheel encoder totals (degrees, as MotorDriver.listeners get them)
+    into how far the robot has driven and turned since it was last asked.
+
+    flipL / flipR say which encoders count backwards when their wheel drives forward,
+    cm_per_degree and rad_per_degree are how far one degree of wheel travel moves the
+    robot when both wheels go the same way and opposite ways respectively.
+    """
+
+    def __init__(
+        self,
+        cm_per_degree: float,
+        rad_per_degree: float,
+        flipL: bool = False,
+        flipR: bool = False,
+        step: float = 2.0,
+        turn_step: float = math.radians(3),
+    ):
+        self.cm_per_degree = cm_per_degree
+        self.rad_per_degree = rad_per_degree
+        self.signs = (-1 if flipL else 1, -1 if flipR else 1)
+        self.step = step
+        self.turn_step = turn_step
+        self.last = None
+        self.distance = 0.0
+        self.turn = 0.0
+
+    def update(self, left: float, right: float):
+        if self.last is not None:
+            dl = (left - self.last[0]) * self.signs[0]
+            dr = (right - self.last[1]) * self.signs[1]
+            self.distance += (dl + dr) / 2 * self.cm_per_degree
+            self.turn += (dr - dl) / 2 * self.rad_per_degree
+        self.last = (left, right)
+
+    def pending(self) -> bool:
+        """
+        Whether enough motion has built up to be worth a particle update
+        """
+        return abs(self.distance) >= self.step or abs(self.turn) >= self.turn_step
+
+    def take(self) -> tuple[float, float]:
+        """
+        The (distance, turn) since the last take
+        """
+        motion = self.distance, self.turn
+        self.distance = self.turn = 0.0
+        return motion
@@ -0,0 +1,135 @@
+import math
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class PoseEstimate:
+    """
+    Weighted mean pose of a set of particles, with theta averaged on the circle, and
+    the 3x3 covariance of (x, y, theta) about it
+    """
+
+    x: float
+    y: float
+    theta: float
+    cov: np.ndarray
+    weight: float = 1.0  # Total weight of the particles it summarises
+
+    def pose(self) -> tuple[float, float, float]:
+        return self.x, self.y, self.theta
+
+    @property
+    def sd(self) -> np.ndarray:
+        return np.sqrt(np.diag(self.cov))
+
+
+def weighted_pose(x, y, theta, weight) -> PoseEstimate:
+    total = float(weight.sum())
+    w = weight / total
+    mean_theta = math.atan2(w @ np.sin(theta), w @ np.cos(theta))
+    mean_x, mean_y = float(w @ x), float(w @ y)
+    # Angles measured from the mean, so a cloud straddling +-pi isn't spread round the circle
+    diff = np.stack(
+        [
+            x - mean_x,
+            y - mean_y,
+            (theta - mean_theta + math.pi) % (2 * math.pi) - math.pi,
+        ]
+    )
+    return PoseEstimate(mean_x, mean_y, mean_theta, (diff * w) @ diff.T, total)
+
+
+def top_cluster(
+    x, y, theta, weight, cell: float = 10.0, theta_cell: float = math.radians(30)
+) -> PoseEstimate:
+    """
+    Estimate from only the heaviest (cell, cell, theta_cell) bin of particles and the
+    bins next to it, so a cloud split between two places gives one of them rather
+    than a point in between
+    """
+    i = np.floor(x / cell).astype(int)
+    j = np.floor(y / cell).astype(int)
+    i -= i.min()
+    j -= j.min()
+    bins = int(round(2 * math.pi / theta_cell))
+    k = np.floor((theta + math.pi) / (2 * math.pi) * bins).astype(int) % bins
+    cells = np.bincount((i * (j.max() + 1) + j) * bins + k, weights=weight)
+    best_i, best_j, best_k = np.unravel_index(
+        np.argmax(cells), (i.max() + 1, j.max() + 1, bins)
+    )
+    near = (
+        (np.abs(i - best_i) <= 1)
+        & (np.abs(j - best_j) <= 1)
+        & ((k - best_k + 1) % bins <= 2)
+    )
+    return weighted_pose(x[near], y[near], theta[near], weight[near])
+
+
+def hypotheses(
+    x,
+    y,
+    theta,
+    weight,
+    cell: float = 10.0,
+    theta_cell: float = math.radians(30),
+    min_weight: float = 0.05,
+    min_bin_weight: float = 1e-3,
+) -> list[PoseEstimate]:
+    """
+    Split a cloud into its separate modes, heaviest first.
+
+    Particles are binned into (cell, cell, theta_cell) bins and touching occupied bins
+    (theta wrapping round) are joined into clusters. Bins holding less than
+    min_bin_weight of the total weight count as empty, so a thin scatter of particles
+    doesn't join everything up, and clusters holding less than min_weight of the
+    total are left out.
+    """
+    i = np.floor(x / cell).astype(int)
+    j = np.floor(y / cell).astype(int)
+    i -= i.min()
+    j -= j.min()
+    bins = int(round(2 * math.pi / theta_cell))
+    k = np.floor((theta + math.pi) / (2 * math.pi) * bins).astype(int) % bins
+    shape = (i.max() + 1, j.max() + 1, bins)
+    flat = np.ravel_multi_index((i, j, k), shape)
+    mass = np.bincount(flat, weights=weight, minlength=math.prod(shape))
+    occupied = (mass >= min_bin_weight * mass.sum()).reshape(shape)
+
+    # Connected components by repeatedly taking the smallest label of any neighbour
+    empty = occupied.size
+    labels = np.where(occupied, np.arange(empty).reshape(shape), empty)
+    while True:
+        padded = np.pad(labels, ((1, 1), (1, 1), (0, 0)), constant_values=empty)
+        padded = np.concatenate([padded[..., -1:], padded, padded[..., :1]], axis=2)
+        merged = labels
+        for di in range(3):
+            for dj in range(3):
+                for dk in range(3):
+                    merged = np.minimum(
+                        merged,
+                        padded[
+                            di : di + shape[0], dj : dj + shape[1], dk : dk + shape[2]
+                        ],
+                    )
+        # Labels are bin indices, so jump straight to the label that bin has now
+        merged = np.where(
+            occupied, merged.ravel()[np.minimum(merged, empty - 1)], empty
+        )
+        if np.array_equal(merged, labels):
+            break
+        labels = merged
+
+    _, cluster = np.unique(labels.ravel()[flat], return_inverse=True)
+    cluster = cluster.ravel()
+    masses = np.bincount(cluster, weights=weight)
+    masses[cluster[labels.ravel()[flat] == empty]] = 0  # Particles in empty bins
+    total = weight.sum()
+    return [
+        weighted_pose(
+            x[cluster == c], y[cluster == c], theta[cluster == c], weight[cluster == c]
+        )
+        for c in np.argsort(masses)[::-1]
+        if masses[c] >= min_weight * total
+    ]
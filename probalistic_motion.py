@@ -1,12 +1,14 @@
 from __future__ import annotations
 
-from dataclasses import dataclass, field, replace
+from dataclasses import dataclass, replace
 import math
-from random import gauss
+import numpy as np
 from time import sleep
 import os
 import sys
 from draw import draw_line, draw_particles, draw_particle_with_dir
+from odometry import Odometry
+from pose_estimate import PoseEstimate, hypotheses, top_cluster, weighted_pose
 
 VISUALISATION = not bool(len(sys.argv) > 1)
 
@@ -43,6 +45,10 @@ VERBOSE = False
 
 OFS = 1.5
 
+# The move and turn that Robot.e/f and Robot.g were measured over
+NOISE_DISTANCE = 20.0
+NOISE_ANGLE = math.pi / 2
+
 
 @dataclass
 class Position:
@@ -94,12 +100,133 @@ class WeightedPosition:
         return WeightedPosition(pos=replace(self.pos), weight=weight)
 
 
-@dataclass
 class ParticleCloud:
-    particles: list[WeightedPosition] = field(default_factory=list)
+    """
+    Particles stored as contiguous x, y, theta and weight columns (rows of self.data),
+    so motion, noise and resampling are whole-array operations.
+    Iterating still gives WeightedPosition objects, but they are copies.
+
+    Pose estimates are cached until the cloud changes. The methods here see to that,
+    anything writing to the arrays directly must call changed() afterwards.
+    """
+
+    def __init__(self, x, y, theta, weight):
+        self.data = np.array([x, y, theta, weight], dtype=float)
+        self._estimates = {}
+
+    @classmethod
+    def wrap(cls, data: np.ndarray) -> "ParticleCloud":
+        """
+        Cloud over an existing (4, N) array, without copying it
+        """
+        cloud = cls.__new__(cls)
+        cloud.data = data
+        cloud._estimates = {}
+        return cloud
+
+    @classmethod
+    def at(cls, n: int, x: float, y: float, theta: float) -> "ParticleCloud":
+        return cls(np.full(n, x), np.full(n, y), np.full(n, theta), np.full(n, 1.0 / n))
+
+    @property
+    def x(self) -> np.ndarray:
+        return self.data[0]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self.data[1]
+
+    @property
+    def theta(self) -> np.ndarray:
+        return self.data[2]
+
+    @property
+    def weight(self) -> np.ndarray:
+        return self.data[3]
+
+    @property
+    def particles(self) -> list[WeightedPosition]:
+        return list(self)
+
+    @particles.setter
+    def particles(self, particles: list[WeightedPosition]):
+        self.data = np.array(
+            [(p.pos.x, p.pos.y, p.pos.theta, p.weight) for p in particles], dtype=float
+        ).T.copy()
+        self.changed()
+
+    def __len__(self):
+        return self.data.shape[1]
 
     def __iter__(self):
-        return iter(self.particles)
+        for x, y, theta, weight in self.data.T.tolist():
+            yield WeightedPosition(pos=Position(x, y, theta), weight=weight)
+
+    def move_forward(self, D):
+        """
+        Move every particle forward, D is a scalar or one distance per particle
+        """
+        self.x[:] += np.cos(self.theta) * D
+        self.y[:] -= np.sin(self.theta) * D  # Unflip axis
+        assert np.abs(self.data[:2]).max() < 400, "particles left the world"
+        self.changed()
+
+    def rotate(self, angle):
+        self.theta[:] = Position.normalise(self.theta + angle)
+        self.changed()
+
+    def move_arc(self, D, turn):
+        """
+        Drive every particle D along a circular arc that turns it by turn, with the
+        arc equations of planning_navigation.predictPosition (y flipped, as in
+        move_forward). Both may be scalars or one per particle
+        """
+        D = np.broadcast_to(D, self.x.shape)
+        turn = np.broadcast_to(turn, self.x.shape)
+        straight = np.abs(turn) < 1e-9
+        with np.errstate(divide="ignore", invalid="ignore"):
+            R = np.where(straight, 0.0, D / turn)
+        theta, end = self.theta, self.theta + turn
+        self.x[:] += np.where(
+            straight, D * np.cos(theta), R * (np.sin(end) - np.sin(theta))
+        )
+        self.y[:] += np.where(
+            straight, -D * np.sin(theta), R * (np.cos(end) - np.cos(theta))
+        )
+        self.theta[:] = Position.normalise(end)
+        assert np.abs(self.data[:2]).max() < 400, "particles left the world"
+        self.changed()
+
+    def resample(self, idx: np.ndarray):
+        """
+        Keep the particles at idx (repeats allowed), all with equal weight
+        """
+        self.data = self.data[:, idx]
+        self.weight[:] = 1.0 / len(idx)
+        self.changed()
+
+    def changed(self):
+        self._estimates = {}
+
+    def estimate(self, mode: bool = False) -> PoseEstimate:
+        """
+        Weighted mean and covariance of the whole cloud, or with mode=True of just
+        its heaviest cluster (pose_estimate.top_cluster)
+        """
+        if mode not in self._estimates:
+            summarise = top_cluster if mode else weighted_pose
+            self._estimates[mode] = summarise(self.x, self.y, self.theta, self.weight)
+        return self._estimates[mode]
+
+    def hypotheses(self) -> list[PoseEstimate]:
+        """
+        The cloud's separate modes, heaviest first (pose_estimate.hypotheses)
+        """
+        if "hypotheses" not in self._estimates:
+            self._estimates["hypotheses"] = hypotheses(
+                self.x, self.y, self.theta, self.weight
+            )
+        return self._estimates["hypotheses"]
 
 
 from typing import TYPE_CHECKING, Callable, TypeVar
@@ -131,7 +258,12 @@ class Robot:
         start_y: float = 0.0,
         start_theta: float = 0.0,
         VIS=False,
+        odometry: bool = False,
     ):
+        """
+        odometry: move the particles by what the wheel encoders say as the robot
+        drives, a few cm at a time, rather than by the commanded distance at the end
+        """
         # Initialize the robot at the center of the world
         self.e = 3 # Fwd dist uncertainty [measured]
         self.f = 3 * math.pi/180 # Fwd rot uncertainty
@@ -144,24 +276,25 @@ class Robot:
         self.TURN_SCALING = 1.1 * 2 / math.pi
         self.driver = MotorDriver(self.motorL, self.motorR, self.speed)
         self.driver.flipR = True
-        self.particle_cloud = ParticleCloud(
-            [
-                WeightedPosition(
-                    pos=Position(start_x, start_y, start_theta), weight=1.0 / num_points
-                )
-                for _ in range(num_points)
-            ]
+        # A spin turns each wheel TURN_SCALING rotations per radian, half the base
+        self.driver.rotations_per_cm = self.FWD_SCALING
+        self.driver.wheel_base = 2 * self.TURN_SCALING / self.FWD_SCALING
+        self.rng = np.random.default_rng()
+        self.particle_cloud = ParticleCloud.at(
+            num_points, start_x, start_y, start_theta
         )
+        self.odometry = None
+        if odometry:
+            self.odometry = Odometry(
+                1 / (360 * self.FWD_SCALING),
+                1 / (360 * self.TURN_SCALING),
+                self.driver.flipL,
+                self.driver.flipR,
+            )
+            self.driver.listeners.append(self.on_encoders)
 
-    def getMeanPos(self):
-        pos = sum(
-            [
-                particle.pos * particle.weight
-                for particle in self.particle_cloud.particles
-            ],
-            Position(0, 0, 0),
-        )
-        return pos.x, pos.y, pos.theta
+    def getMeanPos(self, mode: bool = False):
+        return self.particle_cloud.estimate(mode).pose()
 
     def calibration_spin(self):
         old_theta = self.getMeanPos()[2]
@@ -207,27 +340,96 @@ class Robot:
     def move_forward(self, D):
         print(f"move_forward: {D}")
         self.driver.move_forward(D * self.FWD_SCALING)
-        for particle in self.particle_cloud:
-            e = gauss(0, self.e)
-            f = gauss(0, self.f)
-            particle.move_forward(D + e)
-            particle.rotate(f)
+        if self.odometry is None:
+            self.predict_forward(D)
+        else:
+            self.predict_motion(*self.odometry.take())
         print("mean pos", self.getMeanPos())
 
     # Call when we rotate the robot at each corner
     @motion
     def rotate(self, angle):
         self.driver.rotate(angle * self.TURN_SCALING)
-        for particle in self.particle_cloud:
-            g = gauss(0, self.g)
-            particle.rotate(angle + g)
+        if self.odometry is None:
+            self.predict_rotate(angle)
+        else:
+            self.predict_motion(*self.odometry.take())
         print("rot mean pos", self.getMeanPos())
 
+    @motion
+    def drive_arc(self, radius, arc_length):
+        """
+        Drive arc_length around a circle of radius, turning the way a positive
+        rotate does for a positive radius (MotorDriver.drive_arc)
+        """
+        print(f"drive_arc: {radius=}, {arc_length=}")
+        self.driver.drive_arc(radius, arc_length)
+        if self.odometry is None:
+            self.predict_arc(arc_length, arc_length / radius)
+        else:
+            self.predict_motion(*self.odometry.take())
+        print("arc mean pos", self.getMeanPos())
+
+    def navigateToWaypointArc(self, x, y, i=20):
+        """
+        Like navigateToWaypoint, but curve onto the waypoint along the circle that
+        leaves in the current heading, rather than stopping to turn first.
+        Only turns on the spot when the waypoint is behind
+        """
+        r, theta = self.getTargeting(x, y)
+        if abs(theta) > math.pi / 2:
+            self.rotate(theta)
+            r, theta = self.getTargeting(x, y)
+        r -= OFS
+        if abs(theta) < 1e-3:
+            self.move_forward(min(r, i))
+        else:
+            # Circle through the waypoint, tangent to the heading: it turns 2 * theta
+            radius = r / (2 * math.sin(theta))
+            self.drive_arc(radius, min(2 * theta * radius, i))
+        if r > i:
+            sleep(0.5)
+            self.navigateToWaypointArc(x, y, i)
+
+    # Motion updates for the particles, separate from driving so they can be swapped out.
+    # noise scales the standard deviations, for moves other than a whole command
+    def predict_forward(self, D, noise=1.0):
+        n = len(self.particle_cloud)
+        self.particle_cloud.move_forward(D + self.rng.normal(0, self.e * noise, n))
+        self.particle_cloud.rotate(self.rng.normal(0, self.f * noise, n))
+
+    def predict_rotate(self, angle, noise=1.0):
+        n = len(self.particle_cloud)
+        self.particle_cloud.rotate(angle + self.rng.normal(0, self.g * noise, n))
+
+    def predict_arc(self, distance, turn, noise=1.0):
+        n = len(self.particle_cloud)
+        scale = noise * math.sqrt(abs(distance) / NOISE_DISTANCE)
+        turn_sd = noise * math.hypot(
+            self.f * math.sqrt(abs(distance) / NOISE_DISTANCE),
+            self.g * math.sqrt(abs(turn) / NOISE_ANGLE),
+        )
+        self.particle_cloud.move_arc(
+            distance + self.rng.normal(0, self.e * scale, n),
+            turn + self.rng.normal(0, turn_sd, n),
+        )
+
+    def predict_motion(self, distance, turn):
+        # e, f and g were measured over whole commands, the variance grows with
+        # how far the robot actually went
+        if distance:
+            self.predict_forward(distance, math.sqrt(abs(distance) / NOISE_DISTANCE))
+        if turn:
+            self.predict_rotate(turn, math.sqrt(abs(turn) / NOISE_ANGLE))
+
+    def on_encoders(self, left, right):
+        self.odometry.update(left, right)
+        if self.odometry.pending():
+            self.predict_motion(*self.odometry.take())
+
     def update(self):
         if self.VIS:
-            draw_particles(
-                [(p.pos.x, p.pos.y, p.pos.theta) for p in self.particle_cloud]
-            )
+            draw_particles(self.particle_cloud.data[:3].T.tolist())
             draw_particle_with_dir(*self.getMeanPos())
 
 
@@ -0,0 +1,135 @@
+import hashlib
+import math
+import os
+
+import numpy as np
+
+MAX_RANGE = 185  # Past this the sonar reading is garbage (see sensor_findings.md)
+MAX_READING = 255  # What the sonar reports when it gets no echo back
+
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+
+class RaycastTable:
+    """
+    arena.cast sampled on an (x, y, theta) grid over the bounding box of the walls,
+    for an arena_map.ArenaMap (or anything with the same segments and cast).
+
+    The table is saved under CACHE_DIR keyed on a hash of the walls and resolution, and
+    memory-mapped on load, so it is only computed the first time a map is used.
+    """
+
+    def __init__(self, table: np.ndarray, arena, xy_res: float, theta_res: float):
+        self.table = table
+        self.xy_res = xy_res
+        self.theta_res = theta_res
+        self.x0 = arena.segments[:, [0, 2]].min()
+        self.y0 = arena.segments[:, [1, 3]].min()
+
+    @staticmethod
+    def shape(segments: np.ndarray, xy_res: float, theta_res: float):
+        nx = int((segments[:, [0, 2]].max() - segments[:, [0, 2]].min()) // xy_res) + 1
+        ny = int((segments[:, [1, 3]].max() - segments[:, [1, 3]].min()) // xy_res) + 1
+        return nx, ny, int(round(2 * math.pi / theta_res))
+
+    @staticmethod
+    def path(segments: np.ndarray, xy_res: float, theta_res: float, cache_dir: str):
+        key = hashlib.sha1(b"arena_map")  # Older tables had other rules, never reuse them
+        key.update(segments.astype(float).tobytes())
+        key.update(np.array([xy_res, theta_res], dtype=float).tobytes())
+        return os.path.join(cache_dir, f"raycast-{key.hexdigest()[:16]}.npy")
+
+    @classmethod
+    def build(cls, arena, xy_res: float = 1.0, theta_res: float = math.radians(2)):
+        segments = arena.segments
+        nx, ny, nt = cls.shape(segments, xy_res, theta_res)
+        x0, y0 = segments[:, [0, 2]].min(), segments[:, [1, 3]].min()
+        xs, ys = np.meshgrid(
+            x0 + xy_res * np.arange(nx), y0 + xy_res * np.arange(ny), indexing="ij"
+        )
+        xs, ys = xs.ravel(), ys.ravel()
+
+        table = np.empty((nx, ny, nt), dtype=np.float32)
+        for k in range(nt):
+            # Same range as Position.normalise, which is what particles will have
+            theta = (k * theta_res + math.pi) % (2 * math.pi) - math.pi
+            thetas = np.full_like(xs, theta)
+            table[:, :, k] = arena.cast(xs, ys, thetas).reshape(nx, ny)
+        return cls(table, arena, xy_res, theta_res)
+
+    @classmethod
+    def load(
+        cls,
+        arena,
+        xy_res: float = 1.0,
+        theta_res: float = math.radians(2),
+        cache_dir: str = CACHE_DIR,
+    ):
+        path = cls.path(arena.segments, xy_res, theta_res, cache_dir)
+        if not os.path.exists(path):
+            print("Building ray cast table", path)
+            table = cls.build(arena, xy_res, theta_res).table
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write then rename, so a half written table never gets loaded
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, table)
+            os.replace(path + ".tmp", path)
+        return cls(np.load(path, mmap_mode="r"), arena, xy_res, theta_res)
+
+    def lookup(self, x, y, theta, interpolate: bool = False) -> np.ndarray:
+        """
+        Same as arena.cast(x, y, theta) up to the grid resolution.
+        Poses outside the walls' bounding box never see a wall (inf).
+        """
+        nx, ny, nt = self.table.shape
+        fx = (np.asarray(x, dtype=float) - self.x0) / self.xy_res
+        fy = (np.asarray(y, dtype=float) - self.y0) / self.xy_res
+        ft = np.mod(theta, 2 * math.pi) / self.theta_res
+        inside = (fx >= 0) & (fx <= nx - 1) & (fy >= 0) & (fy <= ny - 1)
+        fx = np.clip(fx, 0, nx - 1)
+        fy = np.clip(fy, 0, ny - 1)
+
+        i, j, k = (
+            np.rint(fx).astype(int),
+            np.rint(fy).astype(int),
+            np.rint(ft).astype(int),
+        )
+        dists = self.table[i, j, k % nt]
+
+        if interpolate:
+            i0 = np.minimum(fx.astype(int), nx - 2)
+            j0 = np.minimum(fy.astype(int), ny - 2)
+            k0 = ft.astype(int)
+            dx, dy, dt = fx - i0, fy - j0, ft - k0
+            corners = np.stack(
+                [
+                    self.table[i0 + a, j0 + b, (k0 + c) % nt]
+                    for a in (0, 1)
+                    for b in (0, 1)
+                    for c in (0, 1)
+                ]
+            )
+            weights = np.stack(
+                [
+                    (dx if a else 1 - dx)
+                    * (dy if b else 1 - dy)
+                    * (dt if c else 1 - dt)
+                    for a in (0, 1)
+                    for b in (0, 1)
+                    for c in (0, 1)
+                ]
+            )
+            # Don't blend across a 255/inf edge, those cells keep the nearest value
+            smooth = (corners < MAX_READING).all(axis=0)
+            blended = (np.where(smooth, corners, 0) * weights).sum(axis=0)
+            dists = np.where(smooth, blended, dists)
+
+        return np.where(inside, dists, np.inf)
+
+
+if __name__ == "__main__":
+    # Build step: python raycast.py prebuilds the table for the arena in mcl.py
+    from mcl import ARENA
+
+    RaycastTable.load(ARENA)
@@ -0,0 +1,231 @@
+import atexit
+import multiprocessing
+import os
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+import raycast
+from arena_map import ArenaMap
+from likelihood_field import LikelihoodField
+from mcl import NormRobot, SonarModel, logsumexp
+from probalistic_motion import ParticleCloud
+
+
+def worker(
+    conn,
+    names,
+    n,
+    start,
+    stop,
+    arena: ArenaMap,
+    model: SonarModel,
+    use_table,
+    use_field,
+    wall_motion,
+    seed,
+):
+    """
+    Owns particles [start, stop) of the shared cloud. Commands come in over conn and
+    only scalars (and the resample indices, via shared memory) go back and forth
+    """
+    shms = [SharedMemory(name) for name in names]
+    buffers = [np.ndarray((4, n), dtype=float, buffer=shm.buf) for shm in shms[:2]]
+    indices = np.ndarray((n,), dtype=np.int64, buffer=shms[2].buf)
+    table = raycast.RaycastTable.load(arena) if use_table else None
+    field = LikelihoodField.load(arena) if use_field else None
+    rng = np.random.default_rng(seed)
+    current = 0
+    log_w = None
+    crossed = None  # Which particles went through a wall on the last forward
+
+    while True:
+        cmd, *args = conn.recv()
+        cloud = ParticleCloud.wrap(buffers[current][:, start:stop])
+        m = stop - start
+
+        if cmd == "forward":
+            D, e, f = args
+            x0, y0 = cloud.x.copy(), cloud.y.copy()
+            cloud.move_forward(D + rng.normal(0, e, m))
+            cloud.rotate(rng.normal(0, f, m))
+            if wall_motion is None:
+                conn.send((0, 1.0))
+                continue
+            # As NormRobot.check_walls, but the weights are renormalised by the
+            # parent, which needs every slice's surviving weight
+            t, walls = arena.crossings(x0, y0, cloud.x, cloud.y)
+            crossed = np.isfinite(t)
+            if wall_motion == "reflect" and crossed.any():
+                cloud.x[crossed], cloud.y[crossed] = arena.reflect(
+                    cloud.x[crossed], cloud.y[crossed], walls[crossed]
+                )
+            conn.send((np.count_nonzero(crossed), cloud.weight[~crossed].sum()))
+        elif cmd == "cull":
+            (surviving,) = args
+            cloud.weight[crossed] = 0
+            cloud.weight[:] /= surviving
+            conn.send(None)
+        elif cmd == "rotate":
+            angle, g = args
+            cloud.rotate(angle + rng.normal(0, g, m))
+            conn.send(None)
+        elif cmd == "sense":
+            (z,) = args
+            if field is not None:
+                log_p = field.log_likelihood(cloud.x, cloud.y, cloud.theta, z, model)
+            else:
+                if table is not None:
+                    dists = table.lookup(
+                        cloud.x, cloud.y, cloud.theta, interpolate=True
+                    )
+                else:
+                    dists = arena.cast(cloud.x, cloud.y, cloud.theta)
+                log_p = model.log_likelihood(dists, z)
+            with np.errstate(divide="ignore"):
+                log_w = np.log(cloud.weight) + log_p
+            conn.send(logsumexp(log_w))
+        elif cmd == "normalise":
+            (log_total,) = args
+            cloud.weight[:] = np.exp(log_w - log_total)
+            conn.send(float(np.sum(cloud.weight**2)))
+        elif cmd == "resample":
+            # Gather from the current buffer into the other one, then swap
+            buffers[1 - current][:, start:stop] = buffers[current][
+                :, indices[start:stop]
+            ]
+            buffers[1 - current][3, start:stop] = 1.0 / n
+            current = 1 - current
+            conn.send(None)
+        elif cmd == "stop":
+            break
+
+    for shm in shms:
+        shm.close()
+
+
+class ShardedRobot(NormRobot):
+    """
+    NormRobot with the particle arrays in shared memory, split across a pool of
+    worker processes that run the motion and sensor updates on their slice in place.
+
+    Takes NormRobot's options, except that the particle count is fixed, so no kld,
+    and there is no EKF, so no ekf_tracking. Those raise a ValueError. Sonar updates
+    (ray cast, use_table or use_field) and wall_motion for straight moves run in the
+    workers; arcs, scans and landmark sightings run here on the shared arrays.
+    Resampling indices are computed here and handed to the workers through shared
+    memory, and a whole new cloud (global_localise) is copied into it.
+    """
+
+    def __init__(self, num_points: int, *args, workers: int = 0, **kwargs):
+        for option in ["kld", "ekf_tracking"]:
+            if kwargs.get(option):
+                raise ValueError(f"ShardedRobot does not support {option}")
+        super().__init__(num_points, *args, **kwargs)
+        n = num_points
+        workers = workers or os.cpu_count() or 1
+
+        # Two particle buffers to resample between, and one for the indices
+        self.shms = [
+            SharedMemory(create=True, size=4 * n * 8),
+            SharedMemory(create=True, size=4 * n * 8),
+            SharedMemory(create=True, size=n * 8),
+        ]
+        self.buffers = [
+            np.ndarray((4, n), dtype=float, buffer=shm.buf) for shm in self.shms[:2]
+        ]
+        self.indices = np.ndarray((n,), dtype=np.int64, buffer=self.shms[2].buf)
+        self.current = 0
+        self.buffers[0][:] = self.particle_cloud.data
+        self.particle_cloud = ParticleCloud.wrap(self.buffers[0])
+
+        bounds = np.linspace(0, n, workers + 1).astype(int)
+        seeds = np.random.SeedSequence().spawn(workers)
+        names = [shm.name for shm in self.shms]
+        self.conns = []
+        self.processes = []
+        for start, stop, seed in zip(bounds, bounds[1:], seeds):
+            conn, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=worker,
+                args=(
+                    child,
+                    names,
+                    n,
+                    start,
+                    stop,
+                    self.arena,
+                    self.sonar_model,
+                    self.table is not None,
+                    self.field is not None,
+                    self.wall_motion,
+                    seed,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self.conns.append(conn)
+            self.processes.append(process)
+        atexit.register(self.close)
+
+    def broadcast(self, *message) -> list:
+        # Every worker gets the command before we wait on any of them
+        for conn in self.conns:
+            conn.send(message)
+        return [conn.recv() for conn in self.conns]
+
+    def predict_forward(self, D, noise=1.0):
+        results = self.broadcast("forward", D, self.e * noise, self.f * noise)
+        crossed = sum(count for count, _ in results)
+        surviving = sum(weight for _, weight in results)
+        if crossed:
+            print(f"{crossed} particles went through a wall")
+            # If every particle with any weight did, it's the map that's wrong
+            if self.wall_motion == "kill" and surviving > 0:
+                self.broadcast("cull", surviving)
+        self.particle_cloud.changed()
+
+    def predict_rotate(self, angle, noise=1.0):
+        self.broadcast("rotate", angle, self.g * noise)
+        self.particle_cloud.changed()
+
+    def normalise_probs(self, z):
+        log_total = logsumexp(np.array(self.broadcast("sense", z)))
+        ess = 1.0 / sum(self.broadcast("normalise", log_total))
+        self.particle_cloud.changed()
+
+        n = len(self.particle_cloud)
+        if ess < self.resample_threshold * n:
+            print(f"resampling, effective sample size {ess:.0f}/{n}")
+            self.resample(self.resampler(self.particle_cloud.weight, n, self.rng))
+
+    def resample(self, idx: np.ndarray):
+        # The workers gather their slices, so the cloud stays in shared memory
+        self.indices[:] = idx
+        self.broadcast("resample")
+        self.current = 1 - self.current
+        self.particle_cloud = ParticleCloud.wrap(self.buffers[self.current])
+
+    def set_cloud(self, cloud: ParticleCloud):
+        # Copy it in rather than swap it, the workers only see the shared buffers
+        if len(cloud) != len(self.particle_cloud):
+            raise ValueError(
+                f"ShardedRobot has {len(self.particle_cloud)} particles, not {len(cloud)}"
+            )
+        self.buffers[self.current][:] = cloud.data
+        self.particle_cloud.changed()
+
+    def close(self):
+        if not self.conns:
+            return
+        for conn in self.conns:
+            conn.send(("stop",))
+        for process in self.processes:
+            process.join()
+        self.conns = []
+        self.particle_cloud = ParticleCloud(*self.buffers[self.current])
+        self.buffers = []
+        self.indices = None
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,120 @@
+import time
+
+import brickpi3
+
+MESSAGE = brickpi3.BrickPi3.BPSPI_MESSAGE_TYPE
+
+
+def signed(data, bits: int) -> int:
+    value = int.from_bytes(bytes(data), "big")
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+
+class SimMotor:
+    """
+    A wheel whose speed (degrees per second) heads for gain * dps_per_power * power
+    with a first order lag of time constant tau. Given a position target it heads
+    there instead, at up to its dps limit, slowing over the last 20 degrees
+    """
+
+    def __init__(self, gain: float = 1.0, dps_per_power: float = 10.0, tau=0.08):
+        self.gain = gain
+        self.dps_per_power = dps_per_power
+        self.tau = tau
+        self.position = 0.0  # Degrees turned, before the firmware's encoder offset
+        self.speed = 0.0
+        self.power = 0
+        self.offset = 0
+        self.target = None  # Position control target, in encoder degrees
+        self.dps_limit = 0  # 0 is no limit, as on the BrickPi3
+
+    @property
+    def encoder(self) -> int:
+        return int(self.position) - self.offset
+
+    def goal(self) -> float:
+        if self.target is None:
+            return self.gain * self.dps_per_power * self.power
+        approach = max(-1.0, min(1.0, (self.target - self.encoder) / 20))
+        return approach * (self.dps_limit or 100 * self.dps_per_power)
+
+    def step(self, dt: float):
+        self.speed += (self.goal() - self.speed) * min(1.0, dt / self.tau)
+        self.position += self.speed * dt
+
+
+class SimBrickPi3(brickpi3.BrickPi3):
+    """
+    A BrickPi3 with nothing on the other end of the SPI bus: transfers are answered
+    by simulated motors (on PORT_B and PORT_C by default, the right one on PORT_B
+    10% weaker) and a sonar that always reads `distance`. Messages it doesn't
+    model are accepted and ignored.
+
+    The motors move on with the real clock. Each transfer sleeps `cost`, about
+    what 8 bytes take at 500kHz, and is counted in transactions.
+    """
+
+    def __init__(self, motors=None, distance: int = 42, cost: float = 150e-6):
+        super().__init__(detect=False)
+        if motors is None:
+            motors = {self.PORT_B: SimMotor(0.9), self.PORT_C: SimMotor(1.0)}
+        self.motors = motors
+        self.distance = distance
+        self.cost = cost
+        self.transactions = 0
+        self.time = time.monotonic()
+
+    def advance(self):
+        # Integrate in steps of at most a millisecond, a lot less than tau
+        now = time.monotonic()
+        steps = max(1, int((now - self.time) / 0.001))
+        dt = (now - self.time) / steps
+        self.time = now
+        for _ in range(steps):
+            for motor in self.motors.values():
+                motor.step(dt)
+
+    def spi_transfer_array(self, data_out):
+        self.transactions += 1
+        time.sleep(self.cost)
+        self.advance()
+        # spidev only keeps the low byte of each value, negative powers included
+        data = [byte & 0xFF for byte in data_out]
+        message = data[1]
+        reply = [0] * len(data)
+        motors = [m for p, m in self.motors.items() if len(data) > 2 and data[2] & p]
+
+        if message == MESSAGE.SET_MOTOR_POWER:
+            for motor in motors:
+                motor.power = signed(data[3:4], 8)
+                motor.target = None
+        elif message == MESSAGE.SET_MOTOR_POSITION:
+            for motor in motors:
+                motor.target = signed(data[3:7], 32)
+        elif message == MESSAGE.SET_MOTOR_LIMITS:
+            for motor in motors:
+                motor.dps_limit = int.from_bytes(bytes(data[4:6]), "big")
+        elif message == MESSAGE.OFFSET_MOTOR_ENCODER:
+            for motor in motors:
+                motor.offset += signed(data[3:7], 32)
+        elif MESSAGE.GET_MOTOR_A_ENCODER <= message <= MESSAGE.GET_MOTOR_D_ENCODER:
+            motor = self.motors.get(1 << (message - MESSAGE.GET_MOTOR_A_ENCODER))
+            if motor is not None:
+                reply[3] = 0xA5
+                reply[4:8] = motor.encoder.to_bytes(4, "big", signed=True)
+        elif MESSAGE.GET_MOTOR_A_STATUS <= message <= MESSAGE.GET_MOTOR_D_STATUS:
+            motor = self.motors.get(1 << (message - MESSAGE.GET_MOTOR_A_STATUS))
+            if motor is not None:
+                reply[3] = 0xA5
+                reply[5] = motor.power & 0xFF
+                reply[6:10] = motor.encoder.to_bytes(4, "big", signed=True)
+                reply[10:12] = int(motor.speed).to_bytes(2, "big", signed=True)
+        elif MESSAGE.GET_SENSOR_1 <= message <= MESSAGE.GET_SENSOR_4:
+            reply[3] = 0xA5
+            reply[4] = self.SensorType[message - MESSAGE.GET_SENSOR_1]
+            reply[5] = self.SENSOR_STATE.VALID_DATA
+            reply[6] = self.distance
+
+        # Like xfer2, the reply goes over the request
+        data_out[:] = reply
+        return data_out
@@ -0,0 +1,148 @@
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+import brickpi3
+
+# Same offset MotorDriver.read_sensor adds for the sensor not being at the centre
+OFFSET = 5
+
+
+def hampel(values: np.ndarray, k: float = 3.0) -> Optional[float]:
+    """
+    Median of the readings after dropping any more than k (scaled) MADs from the median
+    """
+    if len(values) == 0:
+        return None
+    median = np.median(values)
+    mad = 1.4826 * np.median(np.abs(values - median))
+    inliers = values[np.abs(values - median) <= k * mad] if mad > 0 else values
+    return float(np.median(inliers))
+
+
+def measure(
+    read,
+    agree: int = 3,
+    tolerance: float = 1.0,
+    max_samples: int = 20,
+    period: float = 0.01,
+) -> tuple[Optional[float], int]:
+    """
+    Take readings until the last `agree` valid ones are within tolerance of each other,
+    or max_samples have been tried. read() returns a reading, or None / raises
+    SensorError for a failed one (like MotorDriver.read_sensor).
+
+    Returns the median of the agreeing readings (of all valid ones if it hit the cap,
+    None if there were none) and the number of samples taken.
+    """
+    readings = []
+    for samples in range(1, max_samples + 1):
+        try:
+            value = read()
+        except brickpi3.SensorError:
+            value = None
+        if value is not None:
+            readings.append(value)
+            last = readings[-agree:]
+            if len(last) == agree and max(last) - min(last) <= tolerance:
+                return float(np.median(last)), samples
+        if samples < max_samples:
+            time.sleep(period)
+    return (float(np.median(readings)) if readings else None), max_samples
+
+
+class SonarService:
+    """
+    Polls the sonar in a background thread into a ring buffer of (time, reading).
+
+    None of the accessors wait on the sensor, they only look at what has already
+    been read, including readings taken while the robot was moving. Its reads share
+    the SPI bus with the main thread's, brickpi3.SPI_LOCK keeps them apart.
+    """
+
+    def __init__(
+        self,
+        BP: "brickpi3.BrickPi3",
+        port,
+        period: float = 0.01,
+        size: int = 512,
+        window: int = 9,
+        offset: float = OFFSET,
+    ):
+        self.BP = BP
+        self.port = port
+        self.period = period
+        self.window = window
+        self.offset = offset
+        self.times = np.zeros(size)
+        self.values = np.zeros(size)
+        self.count = 0  # Total readings ever taken, the next slot is count % size
+        self.errors = 0
+        self.estimate: Optional[float] = None
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        next_t = time.monotonic()
+        while self.running:
+            try:
+                value = self.BP.get_sensor(self.port) + self.offset
+            except brickpi3.SensorError:
+                self.errors += 1
+            else:
+                self.push(time.monotonic(), value)
+            next_t += self.period
+            time.sleep(max(0.0, next_t - time.monotonic()))
+
+    def push(self, t: float, value: float):
+        with self.lock:
+            i = self.count % len(self.values)
+            self.times[i] = t
+            self.values[i] = value
+            self.count += 1
+            recent = self._last(self.window)[1]
+        self.estimate = hampel(recent)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def _last(self, n: int):
+        # Oldest first. Call with the lock held
+        n = min(n, self.count, len(self.values))
+        idx = (self.count - n + np.arange(n)) % len(self.values)
+        return self.times[idx], self.values[idx]
+
+    def latest(self) -> Optional[tuple[float, float]]:
+        """
+        (time, reading) of the most recent reading, None before the first one
+        """
+        with self.lock:
+            if self.count == 0:
+                return None
+            i = (self.count - 1) % len(self.values)
+            return float(self.times[i]), float(self.values[i])
+
+    def since(self, t: float) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Times and readings taken after t (time.monotonic()) still in the buffer
+        """
+        with self.lock:
+            times, values = self._last(len(self.values))
+        keep = times > t
+        return times[keep], values[keep]
+
+    def robust_estimate(self, window: Optional[int] = None) -> Optional[float]:
+        """
+        Hampel filtered median of the last window readings. The default window is
+        kept up to date by the sampler thread, so it costs nothing to read
+        """
+        if window is None or window == self.window:
+            return self.estimate
+        with self.lock:
+            values = self._last(window)[1]
+        return hampel(values)
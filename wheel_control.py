@@ -0,0 +1,267 @@
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from motion_profile import Profile, s_curve, trapezoid
+
+# Roughly how fast a wheel turns (degrees per second) per % of motor power
+DPS_PER_POWER = 9.0
+
+
+@dataclass
+class PID:
+    kp: float
+    ki: float = 0.0
+    kd: float = 0.0
+    limit: float = 50.0  # Most the integral term can contribute
+    integral: float = 0.0
+    last_error: Optional[float] = None
+
+    def reset(self):
+        self.integral = 0.0
+        self.last_error = None
+
+    def step(self, error: float, dt: float) -> float:
+        if self.ki:
+            self.integral += error * dt
+            self.integral = max(
+                -self.limit / self.ki, min(self.limit / self.ki, self.integral)
+            )
+        derivative = 0.0 if self.last_error is None else (error - self.last_error) / dt
+        self.last_error = error
+        return self.kp * error + self.ki * self.integral + self.kd * derivative
+
+
+class LoopTimer:
+    """
+    Paces a loop at a fixed rate, keeping track of how late each tick was (jitter)
+    and how many ticks were missed because an iteration ran over its period
+    """
+
+    def __init__(self, rate: float):
+        self.period = 1.0 / rate
+        self.ticks = 0
+        self.overruns = 0
+        self.total_jitter = 0.0
+        self.max_jitter = 0.0
+        self.start = self.next = self.last = time.monotonic()
+
+    def wait(self) -> float:
+        """
+        Sleep until the next tick, returning the time since the last one
+        """
+        self.next += self.period
+        now = time.monotonic()
+        if now > self.next:
+            # Ran over, skip the ticks we missed rather than rushing to catch up
+            missed = int((now - self.next) / self.period) + 1
+            self.overruns += missed
+            self.next += missed * self.period
+        time.sleep(max(0.0, self.next - now))
+        now = time.monotonic()
+        jitter = now - self.next
+        self.total_jitter += jitter
+        self.max_jitter = max(self.max_jitter, jitter)
+        self.ticks += 1
+        dt, self.last = now - self.last, now
+        return dt
+
+    def summary(self) -> str:
+        mean = self.total_jitter / max(1, self.ticks)
+        return (
+            f"{self.ticks} ticks in {time.monotonic() - self.start:.2f}s, "
+            f"jitter mean {mean * 1000:.2f}ms max {self.max_jitter * 1000:.2f}ms, "
+            f"{self.overruns} overruns"
+        )
+
+
+class WheelController:
+    """
+    Drives the two wheels of a MotorDriver through given encoder distances (degrees)
+    at a fixed control rate.
+
+    The longer wheel follows a motion profile (motion_profile.s_curve by default)
+    and the other a scaled copy of it, so curves keep their ratio. Each tick, power
+    is the profile's speed fed forward plus a PID on how far behind the profile the
+    wheels are, with a second PID on the difference between them to keep them
+    together. Each wheel is cut as soon as it would coast the rest of the way.
+    """
+
+    def __init__(
+        self,
+        driver,
+        rate: float = 50.0,
+        kp: float = 3.0,
+        ki: float = 6.0,
+        kd: float = 0.02,
+        profile: str = "s_curve",
+        accel: float = 3000.0,
+        jerk: float = 30000.0,
+        dps_per_power: float = DPS_PER_POWER,
+        stop_lag: float = 0.08,
+        min_power: float = 15.0,
+        tolerance: float = 3.0,
+    ):
+        """
+        accel, jerk: profile limits in wheel degrees per second^2 and ^3
+        dps_per_power: wheel speed per % of power, for the feed forward
+        stop_lag: how long a wheel keeps turning at its current speed once cut
+        min_power: least power a wheel gets while its profile is still moving
+        tolerance: once the profile is over, how close (degrees) a wheel has to be to
+        its target to stop there
+        """
+        self.driver = driver
+        self.rate = rate
+        self.pid = PID(kp, ki, kd)
+        self.track = PID(kp / 3, ki / 3)
+        self.profile = profile
+        self.accel = accel
+        self.jerk = jerk
+        self.dps_per_power = dps_per_power
+        self.stop_lag = stop_lag
+        self.min_power = min_power
+        self.tolerance = tolerance
+        self.timer = None  # The last move's LoopTimer, for its stats
+
+    def plan(self, distance: float, power: float) -> Profile:
+        v_max = power * self.dps_per_power
+        if self.profile == "trapezoid":
+            return trapezoid(distance, v_max, self.accel)
+        return s_curve(distance, v_max, self.accel, self.jerk)
+
+    def run(self, targetL: float, targetR: float, power: float):
+        """
+        Move until the wheels have turned targetL and targetR degrees (as
+        MotorDriver.read counts them), the further one at up to `power`
+        """
+        driver = self.driver
+        scale = max(abs(targetL), abs(targetR))
+        if scale == 0:
+            return
+        power = min(100.0, power)
+        profile = self.plan(scale, power)
+        driver.reset_encoders()
+        self.pid.reset()
+        self.track.reset()
+        self.timer = LoopTimer(self.rate)
+        doneL = doneR = False
+        elapsed = 0.0
+        dt = self.timer.period
+        last = (0, 0)
+
+        while not (doneL and doneR):
+            l, r = driver.read()
+            # How far each wheel is through its move, in degrees of the longer one
+            progressL = l / targetL * scale if targetL else scale
+            progressR = r / targetR * scale if targetR else scale
+            speedL = (l - last[0]) / targetL * scale / dt if targetL else 0.0
+            speedR = (r - last[1]) / targetR * scale / dt if targetR else 0.0
+            last = (l, r)
+            # Predictive stop: cut a wheel once it would coast the rest of the way
+            doneL = doneL or progressL + max(0.0, speedL) * self.stop_lag >= scale
+            doneR = doneR or progressR + max(0.0, speedR) * self.stop_lag >= scale
+            # After the profile only the tracking PID drives the wheels, don't let it
+            # creep them the last few degrees
+            if elapsed >= profile.duration:
+                doneL = doneL or progressL >= scale - self.tolerance
+                doneR = doneR or progressR >= scale - self.tolerance
+
+            s_ref, v_ref = profile.at(elapsed)
+            base = v_ref / self.dps_per_power + self.track.step(
+                s_ref - (progressL + progressR) / 2, dt
+            )
+            if elapsed < profile.duration:
+                base = max(base, self.min_power)
+            correction = self.pid.step(progressL - progressR, dt)
+            driver.write_left(0 if doneL else clip(base - correction) * targetL / scale)
+            driver.write_right(
+                0 if doneR else clip(base + correction) * targetR / scale
+            )
+            dt = self.timer.wait()
+            elapsed += dt
+
+        driver.write_left(0)
+        driver.write_right(0)
+
+
+def clip(power: float) -> float:
+    return max(0.0, min(100.0, power))
+
+
+class FirmwareController:
+    """
+    Same job as WheelController, but hands both wheels a position target to the
+    BrickPi3 firmware's own control loop and polls get_motor_status at a low rate
+    until they get there.
+
+    Each wheel's speed limit is set in proportion to its distance, so both arrive
+    together.
+    """
+
+    def __init__(
+        self,
+        driver,
+        poll_rate: float = 10.0,
+        dps_per_power: float = DPS_PER_POWER,
+        tolerance: float = 3.0,
+        kp: float = 25.0,
+        kd: float = 70.0,
+    ):
+        self.driver = driver
+        self.poll_rate = poll_rate
+        self.dps_per_power = dps_per_power
+        self.tolerance = tolerance
+        self.kp = kp
+        self.kd = kd
+        self.timer = None
+
+    def run(self, targetL: float, targetR: float, power: float):
+        """
+        Move until the wheels have turned targetL and targetR degrees (as
+        MotorDriver.read counts them), power limiting the motors and the speed of
+        the further wheel
+        """
+        driver = self.driver
+        BP = driver.BP
+        scale = max(abs(targetL), abs(targetR))
+        if scale == 0:
+            return
+        driver.reset_encoders()
+        dps = self.dps_per_power * min(100.0, power)
+        ports = (driver.motorL, driver.motorR)
+        # Targets in raw encoder degrees, the firmware knows nothing of the flips
+        targets = (
+            -targetL if driver.flipL else targetL,
+            -targetR if driver.flipR else targetR,
+        )
+        for port, target in zip(ports, targets):
+            BP.set_motor_position_kp(port, self.kp)
+            BP.set_motor_position_kd(port, self.kd)
+            # A limit of 0 means none at all, so never round down to it
+            BP.set_motor_limits(
+                port, min(100, power), max(1, dps * abs(target) / scale)
+            )
+        for port, target in zip(ports, targets):
+            BP.set_motor_position(port, target)
+
+        # Allow twice the time the move should take at full speed, plus a second
+        timeout = 2 * scale / dps + 1
+        self.timer = LoopTimer(self.poll_rate)
+        try:
+            while True:
+                self.timer.wait()
+                statuses = [BP.get_motor_status(port) for port in ports]
+                encoders = [status[2] for status in statuses]
+                driver.notify(*encoders)
+                if all(
+                    abs(encoder - target) <= self.tolerance and abs(status[3]) < 10
+                    for encoder, target, status in zip(encoders, targets, statuses)
+                ):
+                    break
+                if time.monotonic() - self.timer.start > timeout:
+                    print("firmware move timed out at", encoders, "of", targets)
+                    break
+        finally:
+            for port in ports:
+                BP.set_motor_power(port, 0)
+                BP.set_motor_limits(port, 0, 0)